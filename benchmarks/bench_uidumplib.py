@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Offline benchmark suite for uidumplib: parse synthetic android and iOS
+# hierarchies of different size, depth and attribute density, and report
+# time, throughput and peak memory of every stage.
+#
+# Usage:
+#   python benchmarks/bench_uidumplib.py
+#   python benchmarks/bench_uidumplib.py -n 100 -n 50000 --depth 80 --density 0.9
+#   python benchmarks/bench_uidumplib.py --json > result.json
+#
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from weditor.web import uidumplib  # noqa: E402
+from generators import make_android_xml, make_ios_json  # noqa: E402
+
+
+class FakeWDAClient(object):
+    """ get_ios_hierarchy only needs source(format='json') """
+
+    def __init__(self, source: dict):
+        self._source = source
+
+    def source(self, format='json'):
+        return copy.deepcopy(self._source)
+
+
+def measure(func, repeat):
+    """
+    Returns:
+        (best seconds, peak bytes) the peak is measured in a separate run
+        because tracemalloc slows everything down
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def cases(count, depth, density):
+    """ yield (platform, stage, func, input bytes) """
+    page_xml = make_android_xml(count, max_depth=depth, density=density)
+    android = uidumplib.android_hierarchy_to_json(page_xml)
+    ios_text = make_ios_json(count, max_depth=depth, density=density)
+    ios_source = json.loads(ios_text)
+    ios = uidumplib.ios_hierarchy_to_json(json.loads(ios_text), 3)
+    client = FakeWDAClient(ios_source)
+    android_nodes = uidumplib.flatten_hierarchy(android)
+
+    def build_indexes():
+        snapshot = uidumplib.HierarchySnapshot(0, {"jsonHierarchy": android}, android_nodes)
+        return (snapshot.spatial_index, snapshot.xpath_index, snapshot.query_index)
+
+    yield "android", "parse", lambda: uidumplib.android_hierarchy_to_json(page_xml), len(page_xml)
+    yield "android", "json.dumps", lambda: json.dumps(android), len(page_xml)
+    yield "android", "flatten", lambda: uidumplib.flatten_hierarchy(android), len(page_xml)
+    yield "android", "indexes", build_indexes, len(page_xml)
+    yield "android", "columnar", lambda: uidumplib.hierarchy_to_columns(android_nodes), len(page_xml)
+    # deepcopy of the WDA result is part of every get_ios_hierarchy call here
+    yield "ios", "get_ios_hierarchy", lambda: uidumplib.get_ios_hierarchy(client, 3), len(ios_text)
+    yield "ios", "decode+convert", lambda: uidumplib.ios_hierarchy_to_json(ios_text, 3), len(ios_text)
+    yield "ios", "json.dumps", lambda: json.dumps(ios), len(ios_text)
+
+
+def main():
+    ap = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument("-n", "--nodes", type=int, action="append", help="node count, can be repeated")
+    ap.add_argument("--depth", type=int, default=30, help="max tree depth")
+    ap.add_argument("--density", type=float, default=0.5, help="probability of non-empty text/id/desc attributes")
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="best of N runs")
+    ap.add_argument("--json", action="store_true", help="print results as json")
+    args = ap.parse_args()
+
+    results = []
+    if not args.json:
+        print("%-8s %-18s %7s %9s %10s %12s %9s %10s" % (
+            "platform", "stage", "nodes", "input(KB)", "time(ms)", "nodes/s", "MB/s", "peak(MB)"))
+    for count in args.nodes or [100, 1000, 5000, 20000, 50000]:
+        for platform, stage, func, size in cases(count, args.depth, args.density):
+            seconds, peak = measure(func, args.repeat)
+            result = {
+                "platform": platform,
+                "stage": stage,
+                "nodes": count,
+                "inputBytes": size,
+                "seconds": seconds,
+                "nodesPerSecond": count / seconds,
+                "mbPerSecond": size / seconds / 1024 / 1024,
+                "peakBytes": peak,
+            }
+            results.append(result)
+            if not args.json:
+                print("%-8s %-18s %7d %9d %10.2f %12.0f %9.1f %10.2f" % (
+                    platform, stage, count, size // 1024, seconds * 1000,
+                    result["nodesPerSecond"], result["mbPerSecond"], peak / 1024 / 1024))
+    if args.json:
+        print(json.dumps({
+            "depth": args.depth,
+            "density": args.density,
+            "repeat": args.repeat,
+            "results": results,
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# coding: utf-8
+#
+# Synthetic uiautomator xml and WDA json hierarchies for the benchmarks
+#
+
+import json
+import random
+
+ANDROID_CLASSES = [
+    "android.widget.FrameLayout", "android.widget.LinearLayout",
+    "android.widget.RelativeLayout", "android.widget.TextView",
+    "android.widget.ImageView", "android.widget.Button", "android.view.View",
+    "android.view.ViewGroup", "androidx.recyclerview.widget.RecyclerView",
+]
+
+IOS_TYPES = [
+    "XCUIElementTypeOther", "XCUIElementTypeStaticText",
+    "XCUIElementTypeButton", "XCUIElementTypeImage", "XCUIElementTypeCell",
+    "XCUIElementTypeTable", "XCUIElementTypeScrollView",
+]
+
+
+def make_tree(count: int, max_depth: int = 30, fanout: int = 6, width=1080, height=2400, seed: int = 0):
+    """
+    Random tree of `count` nodes, child rects are inside their parent rect
+
+    Returns:
+        (parents, rects, rnd): parents[i] is the parent index of node i (-1 for
+        node 0), rects[i] is (x, y, width, height); nodes are in document order
+    """
+    rnd = random.Random(seed)
+    parents = [-1]
+    rects = [(0, 0, width, height)]
+    stack = [(0, 0, rnd.randint(1, fanout))]  # (node, depth, children left)
+    while len(parents) < count:
+        if not stack:
+            stack.append((0, 0, rnd.randint(1, fanout)))
+        node, depth, left = stack[-1]
+        if left == 0:
+            stack.pop()
+            continue
+        stack[-1] = (node, depth, left - 1)
+        px, py, pw, ph = rects[node]
+        w = rnd.randint(1, max(1, pw))
+        h = rnd.randint(1, max(1, ph // 2))
+        x = px + rnd.randint(0, pw - w)
+        y = py + rnd.randint(0, max(0, ph - h))
+        parents.append(node)
+        rects.append((x, y, w, h))
+        if depth + 1 < max_depth and rnd.random() < 0.4:
+            stack.append((len(parents) - 1, depth + 1, rnd.randint(1, fanout)))
+
+    # reorder to document order (children right after their parent)
+    children = [[] for _ in parents]
+    for i, p in enumerate(parents[1:], 1):
+        children[p].append(i)
+    order = []
+    todo = [0]
+    while todo:
+        i = todo.pop()
+        order.append(i)
+        todo.extend(reversed(children[i]))
+    position = {old: new for new, old in enumerate(order)}
+    return ([position[parents[i]] if parents[i] >= 0 else -1 for i in order],
+            [rects[i] for i in order], rnd)
+
+
+def _children(parents):
+    children = [[] for _ in parents]
+    for i, p in enumerate(parents[1:], 1):
+        children[p].append(i)
+    return children
+
+
+def make_android_xml(count: int, max_depth: int = 30, fanout: int = 6, density: float = 0.5, seed: int = 0) -> bytes:
+    """
+    uiautomator dump with `count` nodes
+    density: probability that text, resource-id and content-desc are filled
+    """
+    parents, rects, rnd = make_tree(count, max_depth, fanout, seed=seed)
+    children = _children(parents)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?><hierarchy rotation="0">']
+
+    def node_xml(i, index):
+        x, y, w, h = rects[i]
+        return (
+            '<node index="%d" text="%s" resource-id="%s" class="%s" package="com.example.app" '
+            'content-desc="%s" checkable="false" checked="false" clickable="%s" enabled="true" '
+            'focusable="false" focused="false" scrollable="false" long-clickable="false" '
+            'password="false" selected="false" bounds="[%d,%d][%d,%d]"' % (
+                index,
+                "item %d" % i if rnd.random() < density else "",
+                "com.example.app:id/v%d" % rnd.randint(0, 300) if rnd.random() < density else "",
+                rnd.choice(ANDROID_CLASSES),
+                "desc %d" % i if rnd.random() < density / 3 else "",
+                "true" if rnd.random() < 0.3 else "false",
+                x, y, x + w, y + h))
+
+    # node 0 is the screen root, emitted without recursion
+    stack = [(0, 0, False)]
+    while stack:
+        i, index, closing = stack.pop()
+        if closing:
+            parts.append('</node>')
+            continue
+        if children[i]:
+            parts.append(node_xml(i, index) + '>')
+            stack.append((i, index, True))
+            for index, child in reversed(list(enumerate(children[i]))):
+                stack.append((child, index, False))
+        else:
+            parts.append(node_xml(i, index) + ' />')
+    parts.append('</hierarchy>')
+    return ''.join(parts).encode('utf-8')
+
+
+def make_ios_source(count: int, max_depth: int = 30, fanout: int = 6, density: float = 0.5, seed: int = 0) -> dict:
+    """ WDA source(format='json') like tree with `count` nodes (rects in points) """
+    parents, rects, rnd = make_tree(count, max_depth, fanout, width=414, height=896, seed=seed)
+    nodes = []
+    for i, (x, y, w, h) in enumerate(rects):
+        name = "name%d" % rnd.randint(0, 300) if rnd.random() < density else None
+        node = {
+            "type": rnd.choice(IOS_TYPES),
+            "name": name,
+            "label": "label %d" % i if rnd.random() < density else None,
+            "value": "value %d" % i if rnd.random() < density / 3 else None,
+            "rect": {"x": x, "y": y, "width": w, "height": h},
+            "frame": "{{%d, %d}, {%d, %d}}" % (x, y, w, h),
+            "isEnabled": "1",
+            "isVisible": "1" if rnd.random() < 0.8 else "0",
+            "rawIdentifier": name,
+        }
+        nodes.append(node)
+        if parents[i] >= 0:
+            nodes[parents[i]].setdefault("children", []).append(node)
+    return nodes[0]
+
+
+def make_ios_json(count: int, **kwargs) -> str:
+    return json.dumps(make_ios_source(count, **kwargs))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Compare the streaming (expat) android hierarchy parser with the old
+# minidom based one on large synthetic dumps.
+#
+# Usage:
+#   python benchmarks/hierarchy_parse.py
+#   python benchmarks/hierarchy_parse.py -n 1000 -n 15000 --repeat 5
+#
+# See bench_uidumplib.py for the full suite
+#
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from weditor.web import uidumplib  # noqa: E402
+from generators import make_android_xml  # noqa: E402
+
+
+def timeit(func, data, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument("-n", "--nodes", type=int, action="append", help="node count, can be repeated")
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="best of N runs")
+    args = ap.parse_args()
+
+    print("%8s %10s %12s %12s %8s" % ("nodes", "xml(KB)", "minidom(ms)", "expat(ms)", "speedup"))
+    for count in args.nodes or [1000, 5000, 15000]:
+        page_xml = make_android_xml(count)
+        t_dom = timeit(uidumplib.android_hierarchy_to_json_minidom, page_xml, args.repeat)
+        t_expat = timeit(uidumplib.android_hierarchy_to_json, page_xml, args.repeat)
+        print("%8d %10d %12.1f %12.1f %7.1fx" % (
+            count, len(page_xml) // 1024, t_dom * 1000, t_expat * 1000, t_dom / t_expat))
+
+
+if __name__ == '__main__':
+    main()
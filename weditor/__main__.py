@@ -18,15 +18,20 @@ import tornado.web
 import tornado.websocket
 from logzero import logger
 from tornado.log import enable_pretty_logging
-from .web.device import stop_device
+from .web.device import stop_device, set_hierarchy_ttl, set_ios_exclude_attrs, set_health_interval, manager as device_manager
+from .web.screenshot import stop_workers as stop_screenshot_workers, set_stream_max_age
+from .web.executor import set_pool_size, shutdown_executors
+from .web.adbshell import close_sessions as close_adb_sessions
+from .web.recorder import set_segment_seconds, stop_recorders
 
-from .web.handlers.mini import MiniCapHandler, MiniTouchHandler, MiniSoundHandler, sound, MiniPlayerHandler, player, sysInfoThread, stop_sys_info, CameraHandler, camera_stop
+from .web.handlers.mini import MiniCapHandler, MiniTouchHandler, GestureHandler, DeviceChannelHandler, MiniSoundHandler, sound, MiniPlayerHandler, player, sysInfoThread, stop_sys_info, CameraHandler, camera_stop, setFrameQueueSize, setReconnectBackoff
 
 from .web.handlers.page import (
     BaseHandler, DeviceConnectHandler, SysInfoHandler,
-    DeviceHierarchyHandler, DeviceHierarchyHandlerV2, DeviceScreenshotHandler, shotThread, shotQueue,
+    DeviceHierarchyHandler, DeviceHierarchyHandlerV2, DeviceHierarchyAtHandler, DeviceHierarchyRectHandler,
+    DeviceHierarchyXPathHandler, DeviceHierarchyQueryHandler, DeviceScreenshotHandler, ScreenshotStatsHandler, ExecutorStatsHandler, DeviceManagerStatsHandler, MiniCapStatsHandler, UpstreamStatsHandler,
     DeviceWidgetListHandler, setChannels, MainHandler, VersionHandler, WidgetPreviewHandler,
-    DeviceSizeHandler, DeviceTouchHandler, DevicePingHandler, DevicePressHandler, DeviceTextHandler, ListHandler, DeviceScreenrecordHandler, FloatWindowHandler)
+    DeviceSizeHandler, DeviceTouchHandler, DevicePingHandler, DevicePressHandler, DeviceTextHandler, DeviceActionsHandler, ListHandler, DeviceScreenrecordHandler, DeviceRecordingHandler, FloatWindowHandler)
 from .web.handlers.proxy import StaticProxyHandler
 from .web.handlers.shell import PythonShellHandler
 from .web.utils import current_ip, tostr
@@ -95,8 +100,15 @@ def make_app(settings={}):
             (r"/api/v1/text", DeviceTextHandler),
             (r"/api/v1/crop", CropHandler),
             (r"/api/v1/sysInfo", SysInfoHandler),
+            (r"/api/v1/screenshot/stats", ScreenshotStatsHandler),
+            (r"/api/v1/executor/stats", ExecutorStatsHandler),
+            (r"/api/v1/devices/stats", DeviceManagerStatsHandler),
+            (r"/api/v1/minicap/stats", MiniCapStatsHandler),
+            (r"/api/v1/upstream/stats", UpstreamStatsHandler),
             (r"/api/v1/devices/([^/]+)/screenshot", DeviceScreenshotHandler),
+            (r"/api/v1/devices/([^/]+)/actions", DeviceActionsHandler),
             (r"/api/v1/devices/([^/]+)/screenrecord/([^/]+)", DeviceScreenrecordHandler, {"path": uploadPath}),
+            (r"/api/v1/devices/([^/]+)/recording/([^/]+)", DeviceRecordingHandler, {"path": uploadPath}),
             (r"/api/v1/devices/([^/]+)/floatwindow/([^/]+)", FloatWindowHandler),
             (r"/api/v1/devices/([^/]+)/hierarchy", DeviceHierarchyHandler),
             # (r"/api/v1/devices/([^/]+)/exec", DeviceCodeDebugHandler),
@@ -105,6 +117,10 @@ def make_app(settings={}):
             (r"/api/v1/widgets/([^/]+)", DeviceWidgetListHandler),
             # v2
             (r"/api/v2/devices/([^/]+)/hierarchy", DeviceHierarchyHandlerV2),
+            (r"/api/v2/devices/([^/]+)/hierarchy/at", DeviceHierarchyAtHandler),
+            (r"/api/v2/devices/([^/]+)/hierarchy/rect", DeviceHierarchyRectHandler),
+            (r"/api/v2/devices/([^/]+)/hierarchy/xpath", DeviceHierarchyXPathHandler),
+            (r"/api/v2/devices/([^/]+)/hierarchy/query", DeviceHierarchyQueryHandler),
             # widgets
             (r"/widgets/([^/]+)", WidgetPreviewHandler),
             (r"/widgets/(.+/.+)", tornado.web.StaticFileHandler, {
@@ -118,6 +134,8 @@ def make_app(settings={}):
             (r"/ws/v1/camera", CameraHandler),
             (r"/ws/v1/minicap", MiniCapHandler),
             (r"/ws/v1/minitouch", MiniTouchHandler),
+            (r"/ws/v1/gesture", GestureHandler),
+            (r"/ws/v1/device", DeviceChannelHandler),
             (r"/ws/v1/minisound", MiniSoundHandler),
             (r"/ws/v1/miniplayer", MiniPlayerHandler),
             (r"/quit", QuitHandler),
@@ -204,8 +222,10 @@ def run_web(debug=False, port=17310, open_browser=False, force_quit=False):
     player.close()
     camera_stop()
     stop_device(uploadPath)
-    shotQueue.put(None)
-    shotThread.join(5)
+    stop_screenshot_workers()
+    stop_recorders()
+    shutdown_executors()
+    close_adb_sessions()
     sysInfoThread.join(5)
     
     if sys.platform == 'linux':
@@ -254,6 +274,16 @@ def main():
     ap.add_argument('-q', '--quiet', action='store_true', help='quite mode, no open new browser')
     ap.add_argument('-p', '--port', type=int, default=17310, help='local listen port for weditor')
     ap.add_argument("-f", "--force-quit", action='store_true', help="force quit before start")
+    ap.add_argument("--hierarchy-ttl", type=float, default=1.0, help="seconds a hierarchy dump is reused, 0 to disable")
+    ap.add_argument("--segment-seconds", type=int, default=300, help="length of one minicap recording segment")
+    ap.add_argument("--frame-queue", type=int, default=2, help="minicap frames waiting per viewer before the oldest is dropped")
+    ap.add_argument("--reconnect-delay", type=float, default=0.5, help="first delay before a dropped minicap/minitouch stream is opened again, doubled up to --reconnect-max-delay")
+    ap.add_argument("--reconnect-max-delay", type=float, default=30.0, help="longest delay between stream reconnects")
+    ap.add_argument("--reconnect-attempts", type=int, default=10, help="failed reconnects in a row before the viewers are closed")
+    ap.add_argument("--health-interval", type=float, default=30.0, help="seconds between device health checks, 0 to disable")
+    ap.add_argument("--device-threads", type=int, default=4, help="threads per device for blocking device calls")
+    ap.add_argument("--screenshot-max-age", type=float, default=1.0, help="seconds a minicap frame is used for screenshots with fast=1")
+    ap.add_argument("--ios-exclude", default="", help="comma separated iOS node attributes not sent to the browser, eg: frame,rawIdentifier")
     ap.add_argument('--debug', action='store_true', help='open debug mode')
     ap.add_argument('--shortcut', action='store_true', help='create shortcut in desktop')
     ap.add_argument("--quit", action="store_true", help="stop weditor")
@@ -284,12 +314,20 @@ def main():
         args.channels = 2
 
     setChannels(args.channels)
+    set_hierarchy_ttl(args.hierarchy_ttl)
+    set_stream_max_age(args.screenshot_max_age)
+    set_pool_size(args.device_threads)
+    set_health_interval(args.health_interval)
+    setFrameQueueSize(args.frame_queue)
+    setReconnectBackoff(args.reconnect_delay, args.reconnect_max_delay, args.reconnect_attempts)
+    set_segment_seconds(args.segment_seconds)
+    device_manager.start_health_check()
+    set_ios_exclude_attrs([name for name in args.ios_exclude.split(",") if name])
     sound.open(input_device_index=args.device, channels=args.channels)
     if args.play is None:
         player.deviceIndex = args.device
     else:
         player.deviceIndex = args.play
-    shotThread.start()
     sysInfoThread.start()
 
     open_browser = not args.quiet and not args.debug
@@ -72,4 +72,96 @@ function b64toBlob(b64Data, contentType, sliceSize) {
   return new Blob(byteArrays, {
     type: contentType
   });
-}
\ No newline at end of file
+}
+
+/* Hierarchy delta */
+// node id -> copy of the node with its children replaced by child ids
+function flattenHierarchy(source, nodes) {
+  nodes = nodes || {}
+  var node = Object.assign({}, source)
+  if (source.children) {
+    node.children = source.children.map(function (child) {
+      flattenHierarchy(child, nodes)
+      return child._id
+    })
+  }
+  nodes[node._id] = node
+  return nodes
+}
+
+function buildHierarchy(nodes, id) {
+  var node = Object.assign({}, nodes[id])
+  if (node.children) {
+    node.children = node.children.map(function (childId) {
+      return buildHierarchy(nodes, childId)
+    })
+  }
+  return node
+}
+
+// apply the added/removed/changed nodes of a delta response and return the new tree
+function applyHierarchyDelta(nodes, delta) {
+  delta.removed.forEach(function (id) {
+    delete nodes[id]
+  })
+  delta.added.concat(delta.changed).forEach(function (node) {
+    nodes[node._id] = node
+  })
+  return buildHierarchy(nodes, delta.rootId)
+}
+
+/* Columnar hierarchy, see uidumplib.hierarchy_to_columns */
+function decodeColumnarHierarchy(columnar) {
+  function unpack(type, data) {
+    var raw = atob(data)
+    var bytes = new Uint8Array(raw.length)
+    for (var i = 0; i < raw.length; i++) {
+      bytes[i] = raw.charCodeAt(i)
+    }
+    return type == 'bool' ? new Int8Array(bytes.buffer) : new Int32Array(bytes.buffer)
+  }
+
+  var count = columnar.count, strings = columnar.strings, nodes = new Array(count)
+  for (var i = 0; i < count; i++) {
+    nodes[i] = {}
+  }
+  Object.keys(columnar.columns).forEach(function (key) {
+    var column = columnar.columns[key]
+    var data = column.type == 'json' ? column.data : unpack(column.type, column.data)
+    for (var i = 0; i < count; i++) {
+      var v = data[i]
+      if (column.type == 'rect') {
+        if (data[i * 4 + 2] >= 0) {
+          nodes[i].rect = { x: data[i * 4], y: data[i * 4 + 1], width: data[i * 4 + 2], height: data[i * 4 + 3] }
+        }
+      } else if (column.type == 'string') {
+        if (v >= 0) nodes[i][key] = strings[v]
+      } else if (column.type == 'bool') {
+        if (v >= 0) nodes[i][key] = v == 1
+      } else if (column.type == 'int32') {
+        if (v != -2147483648) nodes[i][key] = v
+      } else if (v !== null && v !== undefined) {
+        nodes[i][key] = v
+      }
+    }
+  })
+
+  var parents = nodes.map(function (node) {
+    var p = node._parent
+    delete node._parent
+    return p
+  })
+  var root = null
+  nodes.forEach(function (node, i) {
+    if (parents[i] < 0) {
+      root = node
+    } else {
+      var parent = nodes[parents[i]]
+      if (!parent.children) {
+        parent.children = []
+      }
+      parent.children.push(node)
+    }
+  })
+  return root
+}
@@ -19,6 +19,8 @@ window.vm = new Vue({
     nodeHoveredList: [],
     originNodeMaps: {},
     originNodes: [],
+    hierarchyRevision: null,
+    hierarchyNodes: {}, // node id -> node with children ids, used to apply hierarchy deltas
     autoCopy: true,
     useXPathOnly: false,
     platform: localStorage.platform || 'Android',
@@ -115,16 +117,7 @@ window.vm = new Vue({
       return this.nodeSelected || {};
     },
     elemXPathLite: function () {
-      // scan nodes
-      this.mapAttrCount = {}
-      this.nodes.forEach((n) => {
-        this.incrAttrCount("label", n.label)
-        this.incrAttrCount("resourceId", n.resourceId)
-        this.incrAttrCount("text", n.text)
-        this.incrAttrCount("_type", n._type)
-        this.incrAttrCount("description", n.description)
-      })
-
+      // mapAttrCount is built once per dump in drawAllNodeFromSource
       let node = this.elem;
       const array = [];
       while (node && node._parentId) {
@@ -893,13 +886,29 @@ window.vm = new Vue({
         return this.screenRefresh().then(this.dumpHierarchy)
       }
     },
-    dumpHierarchy: function () { // v2
+    dumpHierarchy: function (live) { // v2
       this.dumping = true
-      return $.getJSON(LOCAL_URL + 'api/v2/devices/' + encodeURIComponent(this.deviceId || '-') + '/hierarchy')
+      let url = LOCAL_URL + 'api/v2/devices/' + encodeURIComponent(this.deviceId || '-') + '/hierarchy?format=columnar'
+      if (live === true && this.hierarchyRevision) {
+        // live dump only asks for the nodes changed since the last revision
+        url += '&since=' + this.hierarchyRevision
+      }
+      return $.getJSON(url)
         .fail((ret) => {
           this.showAjaxError(ret);
         })
         .then((ret) => {
+          this.hierarchyRevision = ret.revision;
+          if (ret.delta) {
+            if (!ret.added.length && !ret.removed.length && !ret.changed.length) {
+              return
+            }
+            ret.jsonHierarchy = applyHierarchyDelta(this.hierarchyNodes, ret);
+          } else {
+            ret.jsonHierarchy = decodeColumnarHierarchy(ret.columnarHierarchy);
+            this.hierarchyNodes = flattenHierarchy(ret.jsonHierarchy);
+          }
+          // a delta has the xml of the new revision too, keep it in step with jsonHierarchy
           localStorage.setItem("xmlHierarchy", ret.xmlHierarchy);
           localStorage.setItem('jsonHierarchy', JSON.stringify(ret.jsonHierarchy));
           localStorage.setItem("activity", ret.activity);
@@ -907,8 +916,10 @@ window.vm = new Vue({
           localStorage.setItem("windowSize", ret.windowSize);
           this.activity = ret.activity; // only for android
           this.packageName = ret.packageName;
+          // node ids are stable across dumps, keep the selection if the node still exists
+          let selectedId = this.nodeSelected && this.nodeSelected._id;
           this.drawAllNodeFromSource(ret.jsonHierarchy);
-          this.nodeSelected = null;
+          this.nodeSelected = this.originNodeMaps[selectedId] || null;
         })
         .always(() => {
           this.dumping = false
@@ -984,7 +995,7 @@ window.vm = new Vue({
         return
       }
       if (this.liveDump) {
-        this.dumpHierarchy()
+        this.dumpHierarchy(true)
           .then(() => {
             this.loadLiveHierarchy()
           })
@@ -1324,6 +1335,16 @@ window.vm = new Vue({
         return nodes;
       }
       this.originNodes = sourceToNodes(source) //ret.nodes;
+
+      // scan nodes
+      this.mapAttrCount = {}
+      this.originNodes.forEach((n) => {
+        this.incrAttrCount("label", n.label)
+        this.incrAttrCount("resourceId", n.resourceId)
+        this.incrAttrCount("text", n.text)
+        this.incrAttrCount("_type", n._type)
+        this.incrAttrCount("description", n.description)
+      })
       this.drawAllNode();
       this.loading = false;
     },
@@ -0,0 +1,171 @@
+# coding: utf-8
+#
+# Batched device actions, run one after another in a single executor call
+#
+
+import math
+import re
+import time
+
+wait_timeout = 10.0  # default seconds of a wait step
+wait_interval = 0.2  # seconds between hierarchy dumps of a wait step
+# the batch holds the input lane of the device, no touch/press/text runs meanwhile
+max_sleep = 30.0
+max_wait_timeout = 60.0
+max_steps = 100
+max_batch_seconds = 120.0  # sum of sleep seconds, wait timeouts and swipe durations
+
+
+def _tap(d, step):
+    d.device.click(int(step["x"]), int(step["y"]))
+    d.invalidate_hierarchy()
+
+
+def _swipe(d, step):
+    d.device.swipe(int(step["x1"]), int(step["y1"]), int(step["x2"]), int(step["y2"]),
+                   float(step.get("duration", 0.1)))
+    d.invalidate_hierarchy()
+
+
+def _key(d, step):
+    key = step["key"]
+    if isinstance(key, str) and key.isdigit():
+        key = int(key)
+    ret = d.device.press(key)
+    d.invalidate_hierarchy()
+    return ret
+
+
+def _text(d, step):
+    ret = d.shell(['input', 'text', step["text"]])[1] == 0
+    d.invalidate_hierarchy()
+    return ret
+
+
+def _sleep(d, step):
+    time.sleep(float(step["seconds"]))
+
+
+def _wait(d, step):
+    """ dump the hierarchy until the selector or xpath matches, returns the first node """
+    deadline = time.time() + float(step.get("timeout", wait_timeout))
+    while True:
+        snapshot = d.dump_snapshot(True)
+        if step.get("xpath"):
+            nodes = snapshot.query_index.xpath(step["xpath"])
+        else:
+            nodes = snapshot.query_index.select(step["selector"])
+        if nodes:
+            return nodes[0]
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError("element not found")
+        time.sleep(min(wait_interval, remaining))
+
+
+handlers = {
+    "tap": _tap,
+    "swipe": _swipe,
+    "key": _key,
+    "text": _text,
+    "sleep": _sleep,
+    "wait": _wait,
+}
+
+required = {
+    "tap": ("x", "y"),
+    "swipe": ("x1", "y1", "x2", "y2"),
+    "key": ("key",),
+    "text": ("text",),
+    "sleep": ("seconds",),
+    "wait": (),
+}
+
+# seconds a step may hold the input lane: argument, default
+durations = {
+    "swipe": ("duration", 0.1),
+    "sleep": ("seconds", 0.0),
+    "wait": ("timeout", wait_timeout),
+}
+
+# numeric arguments -> maximum, None for coordinates
+numbers = {
+    "tap": {"x": None, "y": None},
+    "swipe": {"x1": None, "y1": None, "x2": None, "y2": None, "duration": max_sleep},
+    "sleep": {"seconds": max_sleep},
+    "wait": {"timeout": max_wait_timeout},
+}
+
+
+def validate(steps):
+    """ raise ValueError for unknown actions and missing arguments, before anything runs """
+    if not isinstance(steps, list):
+        raise ValueError("actions must be a list")
+    if len(steps) > max_steps:
+        raise ValueError("at most %d actions in a batch" % max_steps)
+    total = 0.0
+    for i, step in enumerate(steps):
+        action = step.get("action") if isinstance(step, dict) else None
+        if action not in handlers:
+            raise ValueError("step %d: unknown action %r" % (i, action))
+        for name in required[action]:
+            if name not in step:
+                raise ValueError("step %d: %s requires %s" % (i, action, name))
+        for name, limit in numbers.get(action, {}).items():
+            if name not in step:
+                continue
+            value = step[name]
+            try:
+                if isinstance(value, bool):
+                    raise TypeError()
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError("step %d: %s must be a number" % (i, name))
+            if not math.isfinite(value):
+                raise ValueError("step %d: %s must be a number" % (i, name))
+            if limit is not None and not 0 <= value <= limit:
+                raise ValueError("step %d: %s must be between 0 and %g" % (i, name, limit))
+        if action == "wait" and not step.get("xpath") and not step.get("selector"):
+            raise ValueError("step %d: wait requires selector or xpath" % i)
+        if action in durations:
+            name, default = durations[action]
+            total += float(step.get(name, default))
+            if total > max_batch_seconds:
+                raise ValueError("step %d: sleep, wait and swipe times of a batch exceed %gs" % (i, max_batch_seconds))
+
+
+def run_actions(d, steps, stop_on_error=True) -> dict:
+    """
+    Run validated steps in order on DeviceMeta d
+
+    Returns:
+        {"success", "duration", "steps": [{"index", "action", "success", "result"
+        or "description", "start", "duration"}]} times are seconds, start is
+        relative to the first step. Steps after a failure are not run when
+        stop_on_error is set.
+    """
+    begin = time.time()
+    results = []
+    success = True
+    for i, step in enumerate(steps):
+        start = time.time()
+        result = {"index": i, "action": step["action"]}
+        try:
+            result["result"] = handlers[step["action"]](d, step)
+            result["success"] = True
+        except (TimeoutError, ValueError, re.error) as e:
+            result.update(success=False, description=str(e))
+        except Exception as e:
+            result.update(success=False, description="%s: %s" % (type(e).__name__, e))
+        result["start"] = start - begin
+        result["duration"] = time.time() - start
+        results.append(result)
+        if not result["success"]:
+            success = False
+            if stop_on_error:
+                break
+    return {
+        "success": success,
+        "duration": time.time() - begin,
+        "steps": results,
+    }
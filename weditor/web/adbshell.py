@@ -0,0 +1,145 @@
+# coding: utf-8
+#
+# One long running `adb shell` per device for short commands like
+# `input text` and `input keyevent`, instead of a new shell per command.
+#
+
+import queue
+import shlex
+import subprocess
+import threading
+import time
+
+from logzero import logger
+
+command_timeout = 10.0  # seconds
+retry_interval = 30.0  # seconds before adb is asked again for a device it could not reach
+
+
+class ShellError(Exception):
+    pass
+
+
+class ShellSession(object):
+    """
+    Commands are written to the stdin of `adb -s serial shell` followed by
+    an echo of an end marker with the exit code, the output is read until
+    the marker. A session that fails or times out is closed and started
+    again by the next command.
+    """
+
+    def __init__(self, serial: str):
+        self.serial = serial
+        self.proc = None
+        self.lines = None
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.restarts = 0
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            ["adb", "-s", self.serial, "shell"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.lines = queue.Queue()
+        threading.Thread(target=self.read_lines, args=(self.proc, self.lines),
+                         name="AdbShell:" + self.serial, daemon=True).start()
+        self.restarts += 1
+        logger.info("adb shell session started: %s", self.serial)
+
+    @staticmethod
+    def read_lines(proc, lines):
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def run(self, args, timeout=command_timeout):
+        """
+        Returns:
+            (output, exit_code)
+
+        Raises:
+            ShellError
+        """
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            self.seq += 1
+            self.commands += 1
+            marker = "__WEDITOR_%d__" % self.seq
+            cmdline = " ".join(shlex.quote(arg) for arg in args)
+            try:
+                # the quotes keep the marker out of the command line, which a
+                # legacy shell: service (no shell protocol) echoes on its pty
+                echo = '__WEDITOR_"%d"__$?' % self.seq
+                self.proc.stdin.write(("%s; echo %s\n" % (cmdline, echo)).encode("utf-8"))
+                self.proc.stdin.flush()
+                output = []
+                while True:
+                    line = self.lines.get(timeout=timeout)
+                    if line is None:
+                        raise ShellError("adb shell exited")
+                    line = line.decode("utf-8", errors="replace")
+                    pos = line.find(marker)
+                    if pos >= 0:
+                        output.append(line[:pos])
+                        return "".join(output), int(line[pos + len(marker):].strip() or 1)
+                    if echo not in line:
+                        output.append(line)
+            except (OSError, ValueError, queue.Empty, ShellError) as e:
+                self.close()
+                raise ShellError("adb shell %s: %s" % (self.serial, str(e) or "timeout"))
+
+    def close(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+                self.proc.kill()
+            except OSError:
+                pass
+            self.proc = None
+
+
+sessions = {}  # serial -> ShellSession, or (None, time) when adb could not reach it
+sessions_lock = threading.Lock()
+
+
+def is_available(serial: str) -> bool:
+    """ the device is reachable through the local adb server """
+    try:
+        out = subprocess.run(["adb", "-s", serial, "get-state"], capture_output=True, timeout=5).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return out.strip() == b"device"
+
+
+def get_session(serial: str):
+    """
+    Returns: ShellSession or None if adb can not reach the device, it is
+    checked again after retry_interval seconds
+    """
+    with sessions_lock:
+        session = sessions.get(serial)
+        if isinstance(session, ShellSession):
+            return session
+        if session is not None and time.time() - session[1] < retry_interval:
+            return None
+    if is_available(serial):
+        session = ShellSession(serial)
+    else:
+        logger.info("adb shell session not available: %s", serial)
+        session = (None, time.time())
+    with sessions_lock:
+        current = sessions.get(serial)
+        if isinstance(current, ShellSession):
+            return current
+        sessions[serial] = session
+        return session if isinstance(session, ShellSession) else None
+
+
+def close_sessions():
+    with sessions_lock:
+        closing = [s for s in sessions.values() if isinstance(s, ShellSession)]
+        sessions.clear()
+    for session in closing:
+        session.close()
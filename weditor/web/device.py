@@ -2,8 +2,13 @@
 #
 
 import abc
+import asyncio
+import collections
+import concurrent.futures
+import io
 import os
 import sys
+import threading
 import time
 
 import uiautomator2 as u2
@@ -11,17 +16,140 @@ import wda
 from logzero import logger
 from PIL import Image
 
-from . import uidumplib
+from . import adbshell, uidumplib
 from tornado.ioloop import PeriodicCallback
 
+hierarchy_ttl = 1.0  # seconds a hierarchy dump is reused
+
+
+def set_hierarchy_ttl(seconds: float):
+    global hierarchy_ttl
+    hierarchy_ttl = seconds
+
+
+ios_exclude_attrs = ()  # iOS node attributes not sent to the browser
+
+
+def set_ios_exclude_attrs(names):
+    global ios_exclude_attrs
+    ios_exclude_attrs = tuple(names)
+
+
 class DeviceMeta(metaclass=abc.ABCMeta):
+    max_snapshots = 10  # hierarchy revisions kept for delta requests
+
+    def __init__(self):
+        self._snapshots = collections.OrderedDict()
+        self._snapshot_lock = threading.Lock()
+        self._generation = 0  # bumped by invalidate_hierarchy
+        self._cached = None  # (generation, snapshot) reusable within hierarchy_ttl
+        self._dumping = None  # (generation, Future) of the dump in flight
+
     @abc.abstractmethod
     def screenshot(self) -> Image.Image:
         pass
 
+    def screenshot_jpeg(self) -> bytes:
+        buffer = io.BytesIO()
+        self.screenshot().convert("RGB").save(buffer, format='JPEG')
+        return buffer.getvalue()
+
+    def shell(self, args) -> tuple:
+        """
+        Returns:
+            (output, exit_code)
+        """
+        raise NotImplementedError("shell is not supported on this platform")
+
     def dump_hierarchy(self) -> str:
         pass
 
+    def dump_hierarchy2(self) -> dict:
+        pass
+
+    def invalidate_hierarchy(self):
+        """ called after actions that change the screen (touch, press, text) """
+        with self._snapshot_lock:
+            self._generation += 1
+            self._cached = None
+
+    def dump_snapshot(self, fresh=False) -> uidumplib.HierarchySnapshot:
+        """
+        Dump the hierarchy and record it as a revision.
+        The revision only changes when the node tree changed.
+
+        Concurrent callers share the dump in flight, and a dump is reused for
+        hierarchy_ttl seconds unless fresh is True or it was invalidated.
+        """
+        with self._snapshot_lock:
+            generation = self._generation
+            if not fresh and self._cached is not None:
+                cached_generation, snapshot = self._cached
+                if cached_generation == generation and \
+                        time.time() - snapshot.created < hierarchy_ttl:
+                    return snapshot
+            if self._dumping is not None and self._dumping[0] == generation:
+                future = self._dumping[1]
+                owner = False
+            else:
+                future = concurrent.futures.Future()
+                self._dumping = (generation, future)
+                owner = True
+
+        if not owner:
+            return future.result()
+        try:
+            snapshot = self._dump_snapshot(generation)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._snapshot_lock:
+                if self._dumping is not None and self._dumping[1] is future:
+                    self._dumping = None
+        future.set_result(snapshot)
+        return snapshot
+
+    def _dump_snapshot(self, generation) -> uidumplib.HierarchySnapshot:
+        data = self.dump_hierarchy2()
+        nodes = uidumplib.flatten_hierarchy(data['jsonHierarchy'])
+        with self._snapshot_lock:
+            last = self.last_snapshot()
+            if last is None:
+                revision = int(time.time() * 1000)
+            elif last.nodes == nodes:
+                revision = last.revision
+            else:
+                revision = last.revision + 1
+            snapshot = uidumplib.HierarchySnapshot(revision, data, nodes)
+            self._snapshots.pop(revision, None)
+            self._snapshots[revision] = snapshot
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+            if generation == self._generation:
+                self._cached = (generation, snapshot)
+        return snapshot
+
+    def get_snapshot(self, revision: int):
+        """
+        Returns:
+            HierarchySnapshot or None if the revision is unknown or expired
+        """
+        return self._snapshots.get(revision)
+
+    def last_snapshot(self):
+        if not self._snapshots:
+            return None
+        return next(reversed(self._snapshots.values()))
+
+    def is_alive(self) -> bool:
+        """ health check, called in the background thread of DeviceManager """
+        return True
+
+    def close(self):
+        """ called when DeviceManager replaces the device with a new connection """
+        pass
+
     @abc.abstractproperty
     def device(self):
         pass
@@ -33,7 +161,14 @@ class _AndroidDevice(DeviceMeta):
     screenrecordTimeout = None
     
     def __init__(self, device_url):
+        super().__init__()
         self._d = u2.connect(device_url)
+        # serial or host:port of the local adb server, http urls go through atx-agent only
+        self._serial = device_url if device_url and "://" not in device_url else None
+        self._window_size = None
+        self._rotation = None
+        # runs the device queries which do not depend on the hierarchy dump
+        self._query_pool = concurrent.futures.ThreadPoolExecutor(2, "Query-" + device_url)
 
     def start_screenrecord(self, path):
         r = self._d.http.post("/screenrecord")
@@ -98,22 +233,66 @@ class _AndroidDevice(DeviceMeta):
     def screenshot(self):
         return self._d.screenshot()
 
+    def shell(self, args):
+        """ short commands (input text, input keyevent) reuse one adb shell of the device """
+        session = adbshell.get_session(self._serial) if self._serial else None
+        if session is not None:
+            try:
+                return session.run(args)
+            except adbshell.ShellError as e:
+                logger.warning("%s, retry with atx-agent", e)
+        r = self._d.shell(args)
+        return r[0], r[1]
+
+    def screenshot_jpeg(self):
+        # atx-agent already sends a jpeg, skip decoding and encoding it again
+        data = self._d.screenshot(format='raw')
+        if data[:2] == b'\xff\xd8':
+            return data
+        buffer = io.BytesIO()
+        Image.open(io.BytesIO(data)).convert("RGB").save(buffer, format='JPEG')
+        return buffer.getvalue()
+
     def dump_hierarchy(self):
         return uidumplib.get_android_hierarchy(self._d)
 
     def dump_hierarchy2(self):
-        current = self._d.app_current()
-        page_xml = self._d.dump_hierarchy(pretty=True)
+        """
+        app_current and window_size run while the hierarchy is dumped and parsed.
+        window_size is cached until the hierarchy rotation changes.
+        xmlHierarchy is not pretty formatted, see HierarchySnapshot.pretty_xml
+        """
+        current = self._query_pool.submit(self._d.app_current)
+        window_size = None
+        if self._window_size is None:
+            window_size = self._query_pool.submit(self._d.window_size)
+
+        page_xml = self._d.dump_hierarchy(pretty=False)
         page_json = uidumplib.android_hierarchy_to_json(
             page_xml.encode('utf-8'))
+        rotation = uidumplib.parse_rotation(page_xml)
+
+        if window_size is not None:
+            self._window_size = window_size.result()
+        elif rotation != self._rotation:
+            self._window_size = self._d.window_size()
+        self._rotation = rotation
+        current = current.result()
         return {
             "xmlHierarchy": page_xml,
             "jsonHierarchy": page_json,
             "activity": current['activity'],
             "packageName": current['package'],
-            "windowSize": self._d.window_size(),
+            "windowSize": self._window_size,
         }
 
+    def is_alive(self):
+        return self._d.http.get("/version", timeout=health_timeout).status_code == 200
+
+    def close(self):
+        # queries already submitted still finish
+        self._query_pool.shutdown(wait=False)
+
     @property
     def device(self):
         return self._d
@@ -121,6 +300,7 @@ class _AndroidDevice(DeviceMeta):
 
 class _AppleDevice(DeviceMeta):
     def __init__(self, device_url):
+        super().__init__()
         logger.info("ios connect: %s", device_url)
         if device_url == "":
             c = wda.USBClient()
@@ -137,48 +317,156 @@ class _AppleDevice(DeviceMeta):
             return tidevice.Device().screenshot()
 
     def dump_hierarchy(self):
-        return uidumplib.get_ios_hierarchy(self._client, self.__scale)
+        return uidumplib.get_ios_hierarchy(self._client, self.__scale, ios_exclude_attrs)
 
     def dump_hierarchy2(self):
         return {
             "jsonHierarchy":
-            uidumplib.get_ios_hierarchy(self._client, self.__scale),
+            uidumplib.get_ios_hierarchy(self._client, self.__scale, ios_exclude_attrs),
             "windowSize":
             self._client.window_size(),
         }
 
+    def is_alive(self):
+        self._client.status()
+        return True
+
     @property
     def device(self):
         return self._client
 
 
-cached_devices = {}
+class DeviceManager(object):
+    """
+    Registry of connected devices. Connects run in a small thread pool and
+    concurrent connects of the same device share one attempt. A background
+    thread checks the devices every health_interval seconds, a device that
+    fails is connected again on its next use.
+    """
+
+    def __init__(self):
+        self.devices = {}  # device_id -> DeviceMeta
+        self.stale = set()  # device ids that failed the health check
+        self.connecting = {}  # device_id -> concurrent.futures.Future
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(4, "Connect")
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def connect(self, device_id, fresh=False) -> concurrent.futures.Future:
+        """
+        Returns:
+            Future of DeviceMeta, done at once when the device is connected and healthy
+        """
+        with self.lock:
+            d = self.devices.get(device_id)
+            if d is not None and not fresh and device_id not in self.stale:
+                future = concurrent.futures.Future()
+                future.set_result(d)
+                return future
+            future = self.connecting.get(device_id)
+            if future is None:
+                future = self.connecting[device_id] = self.pool.submit(self._connect, device_id)
+            return future
+
+    def _connect(self, device_id):
+        try:
+            platform, device_url = device_id.split(":", maxsplit=1)
+            logger.info("device connect: %s", device_id)
+            if platform == 'android':
+                d = _AndroidDevice(device_url)
+            elif platform == 'ios':
+                d = _AppleDevice(device_url)
+            else:
+                raise ValueError("Unknown platform", platform)
+            with self.lock:
+                old = self.devices.get(device_id)
+                self.devices[device_id] = d
+                self.stale.discard(device_id)
+            if old is not None:
+                old.close()
+            return d
+        finally:
+            with self.lock:
+                self.connecting.pop(device_id, None)
+
+    def get(self, device_id):
+        """ blocks until the device is connected, not for the IOLoop """
+        return self.connect(device_id).result()
+
+    async def get_async(self, device_id):
+        return await asyncio.wrap_future(self.connect(device_id))
+
+    def start_health_check(self):
+        if health_interval <= 0 or self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.health_check, name="DeviceHealth", daemon=True)
+        self.thread.start()
+
+    def stop_health_check(self):
+        self.stopping.set()
+        self.thread = None
+
+    def health_check(self):
+        while not self.stopping.wait(health_interval):
+            with self.lock:
+                devices = [(k, d) for k, d in self.devices.items() if k not in self.stale]
+            for device_id, d in devices:
+                try:
+                    alive = d.is_alive()
+                except Exception as e:
+                    logger.debug("health check %s: %s", device_id, e)
+                    alive = False
+                if not alive:
+                    logger.warning("device unhealthy, reconnect on next use: %s", device_id)
+                    with self.lock:
+                        self.stale.add(device_id)
+
+    def stats(self) -> list:
+        with self.lock:
+            return [{
+                "deviceId": device_id,
+                "healthy": device_id not in self.stale,
+                "connecting": device_id in self.connecting,
+            } for device_id in self.devices]
+
+
+health_interval = 30.0  # seconds between device health checks, 0 to disable
+health_timeout = 5.0
+
+
+def set_health_interval(seconds: float):
+    global health_interval
+    health_interval = seconds
+
+
+manager = DeviceManager()
+cached_devices = manager.devices
+
 
 def connect_device(platform, device_url):
     """
+    Blocks until connected, not for the IOLoop
+
     Returns:
         deviceId (string)
     """
     device_id = platform + ":" + device_url
-    if platform == 'android':
-        d = _AndroidDevice(device_url)
-    elif platform == 'ios':
-        d = _AppleDevice(device_url)
-    else:
-        raise ValueError("Unknown platform", platform)
-
-    cached_devices[device_id] = d
+    manager.connect(device_id, fresh=True).result()
     return device_id
 
 
 def get_device(id):
-    d = cached_devices.get(id)
-    if d is None:
-        platform, uri = id.split(":", maxsplit=1)
-        connect_device(platform, uri)
-    return cached_devices[id]
+    """ blocks while the device connects, use get_device_async in handlers """
+    return manager.get(id)
+
+
+async def get_device_async(id):
+    return await manager.get_async(id)
 
 def stop_device(path):
-    for d in cached_devices.values():
+    manager.stop_health_check()
+    for d in list(cached_devices.values()):
         d.stop_screenrecord(path)
         # d.device.reset_uiautomator('Stop Device')
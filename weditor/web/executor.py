@@ -0,0 +1,133 @@
+# coding: utf-8
+#
+# Long lived thread pools per device. Blocking device calls of the handlers
+# run here instead of in a new ThreadPoolExecutor per call.
+#
+
+import concurrent.futures
+import threading
+import time
+
+pool_size = 4  # threads per device
+shared_name = "shared"  # executor of calls not bound to a device (files, encoding)
+
+
+def set_pool_size(size: int):
+    global pool_size
+    pool_size = max(1, size)
+
+
+class Call(object):
+    """ timing of one submitted call """
+
+    def __init__(self):
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def wait(self) -> float:
+        """ seconds in the queue """
+        return (self.started or time.time()) - self.submitted
+
+    @property
+    def run(self) -> float:
+        """ seconds of execution """
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+class DeviceExecutor(object):
+    """
+    A pool of pool_size threads for queries (hierarchy, window size, ping) and
+    a single thread lane for input events, which run one by one in submit order.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.size = pool_size
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.size, "Device:" + name)
+        self.lane = concurrent.futures.ThreadPoolExecutor(1, "Input:" + name)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.calls = 0
+        self.ordered_calls = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, func, *args, ordered=False):
+        """
+        Returns:
+            (Call, concurrent.futures.Future)
+        """
+        call = Call()
+
+        def run():
+            call.started = time.time()
+            try:
+                return func(*args)
+            finally:
+                call.finished = time.time()
+                with self.lock:
+                    self.pending -= 1
+                    self.wait_time += call.wait
+                    self.run_time += call.run
+                    self.max_wait = max(self.max_wait, call.wait)
+
+        with self.lock:
+            self.pending += 1
+            self.calls += 1
+            if ordered:
+                self.ordered_calls += 1
+        future = (self.lane if ordered else self.pool).submit(run)
+        return call, future
+
+    def stats(self) -> dict:
+        with self.lock:
+            done = self.calls - self.pending
+            return {
+                "name": self.name,
+                "threads": self.size,
+                "pending": self.pending,
+                "calls": self.calls,
+                "orderedCalls": self.ordered_calls,
+                "avgWait": self.wait_time / done if done else 0.0,
+                "avgRun": self.run_time / done if done else 0.0,
+                "maxWait": self.max_wait,
+            }
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait)
+        self.lane.shutdown(wait)
+
+
+executors = {}
+executors_lock = threading.Lock()
+
+
+def get_executor(name=shared_name) -> DeviceExecutor:
+    with executors_lock:
+        e = executors.get(name)
+        if e is None:
+            e = executors[name] = DeviceExecutor(name)
+        return e
+
+
+def submit(name, func, *args, ordered=False):
+    """ see DeviceExecutor.submit """
+    return get_executor(name).submit(func, *args, ordered=ordered)
+
+
+def get_stats() -> list:
+    with executors_lock:
+        return [e.stats() for e in executors.values()]
+
+
+def shutdown_executors(wait=False):
+    with executors_lock:
+        stopping = list(executors.values())
+        executors.clear()
+    for e in stopping:
+        e.shutdown(wait)
@@ -2,7 +2,8 @@
 #
 from asyncio import Future, get_event_loop, ensure_future
 from logzero import logger
-from ..device import get_device
+from .. import executor, screenshot
+from ..device import get_device_async
 from tornado.websocket import websocket_connect, WebSocketHandler
 from tornado.ioloop import PeriodicCallback
 import pyaudio
@@ -14,6 +15,7 @@ import psutil
 import os
 import json
 import queue
+import collections
 import cv2
 
 cached_devices = {}
@@ -26,6 +28,19 @@ class BaseHandler(WebSocketHandler):
     def check_origin(self, origin: str):
         return True
     
+    def parse_arguments(self):
+        """ parse the query before the upgrade, a ValueError is answered with 400 """
+        pass
+    
+    async def get(self, *args, **kwargs):
+        try:
+            self.parse_arguments()
+        except ValueError as e:
+            self.set_status(400)
+            self.finish({"description": str(e)})
+            return
+        await super().get(*args, **kwargs)
+    
     def send_message(self, msg, bin=False):
         if self.isSent:
             self.isSent = False
@@ -54,58 +69,193 @@ class BaseHandler(WebSocketHandler):
             self.msg = msg
             self.bin = bin
 
+def parse_variant(handler) -> screenshot.Variant:
+    """ quality tier of a viewer from ?maxWidth=&maxHeight=&quality=, raises ValueError """
+    return screenshot.Variant(
+        int(handler.get_query_argument("maxWidth", "0")),
+        int(handler.get_query_argument("maxHeight", "0")),
+        int(handler.get_query_argument("quality")) if handler.get_query_argument("quality", "") else None)
+
+class FrameTier(object):
+    """
+    Viewers sharing one frame size and jpeg quality. Every frame is encoded
+    once in the executor of the stream and sent to all of them. While an
+    encode runs only the newest next frame is kept.
+    """
+
+    def __init__(self, client, variant):
+        self.client = client
+        self.variant = variant
+        self.handlers = []
+        self.last = None  # newest encoded frame, sent to new viewers
+        self.pending = None
+        self.busy = False
+        self.encodedFrames = 0
+        self.skippedFrames = 0
+        self.encodeTime = 0.0
+
+    def push(self, frame):
+        if self.busy:
+            if self.pending is not None:
+                self.skippedFrames += 1
+            self.pending = frame
+            return
+        self.busy = True
+        loop = get_event_loop()
+        # the pool of the device executor, not one of its own per stream
+        call, future = executor.submit(self.client.deviceId, screenshot.encode_image, frame, self.variant)
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self.on_encoded, call, f))
+
+    def on_encoded(self, call, future):
+        self.busy = False
+        if future.exception() is not None:
+            logger.warning("frame encode error: %s", future.exception())
+        elif self.handlers:
+            self.encodedFrames += 1
+            self.encodeTime += call.run
+            self.last = future.result()
+            for handler in self.handlers:
+                try:
+                    handler.send_message(self.last, True)
+                except:
+                    pass
+        if self.pending is not None and self.handlers:
+            frame, self.pending = self.pending, None
+            self.push(frame)
+
+    def stats(self) -> dict:
+        return {
+            "maxWidth": self.variant.max_width,
+            "maxHeight": self.variant.max_height,
+            "quality": self.variant.quality,
+            "viewers": len(self.handlers),
+            "encodedFrames": self.encodedFrames,
+            "skippedFrames": self.skippedFrames,
+            "avgEncode": self.encodeTime / self.encodedFrames if self.encodedFrames else 0.0,
+        }
+
+reconnectDelay = 0.5  # first upstream reconnect delay, doubled after every failure
+reconnectMaxDelay = 30.0
+reconnectAttempts = 10  # failures in a row before the viewers are closed
+
+def setReconnectBackoff(delay, maxDelay, attempts):
+    global reconnectDelay, reconnectMaxDelay, reconnectAttempts
+    reconnectDelay = max(0.1, delay)
+    reconnectMaxDelay = max(reconnectDelay, maxDelay)
+    reconnectAttempts = max(1, attempts)
+
 class ClientHandler(object):
+    """
+    The atx-agent websocket of one stream (minicap or minitouch) shared by
+    its viewers. When it drops while viewers are connected it is opened
+    again with exponential backoff, the viewers, the banner in strs and the
+    last frame are kept.
+    """
     conn = None
     handlers = None
+    tiers = None
     strs = None
     d = None
     last = None
+    lastTime = 0.0
     isMinicap = None
     timeoutDisconn = None
+    closing = False
+    generation = 0
     
-    def __init__(self, id: str, name: str):
+    def __init__(self, id: str, name: str, d):
         self.handlers = []
+        self.tiers = {}  # Variant.key -> FrameTier
         self.strs = {}
+        self.deviceId = id
         self.id = id + "/" + name
-        self.d = get_device(id)
+        self.d = d
         self.isMinicap = (name == 'minicap')
         ws_addr = self.d.device.address.replace("http://", "ws://") # yapf: disable
-        url = ws_addr + "/" + name
+        self.url = ws_addr + "/" + name
+        self.attempts = 0  # failed connects since the last open
+        self.reconnects = 0
+        self.gapStart = None  # upstream lost at
+        self.lastGap = 0.0
+        self.totalGap = 0.0
+        self.reconnectTimer = None
         
-        websocket_connect(url, callback=self.on_open, on_message_callback=self.on_message, connect_timeout=10)
+        self.connect()
         
         cached_devices[self.id] = self
     
-    def on_open(self, future: Future = None):
-        logger.info("client open")
+    def connect(self):
+        self.reconnectTimer = None
+        self.generation += 1
+        generation = self.generation
+        future = websocket_connect(self.url, on_message_callback=lambda message: self.on_message(message, generation), connect_timeout=10)
+        future.add_done_callback(lambda f: self.on_open(f, generation))
+    
+    def on_open(self, future: Future = None, generation=None):
+        if generation != self.generation:
+            return
         try:
             self.conn = future.result()
-        except:
-            self.on_close()
+        except Exception as e:
+            logger.warning("client %s connect error: %s", self.id, e)
+            self.on_lost()
+            return
+        logger.info("client open: %s", self.id)
+        self.attempts = 0
+        if self.gapStart is not None:
+            self.reconnects += 1
+            self.lastGap = time.time() - self.gapStart
+            self.totalGap += self.lastGap
+            self.gapStart = None
+            logger.info("client %s reconnected after %.1fs", self.id, self.lastGap)
     
-    def on_message(self, message):
+    def on_message(self, message, generation=None):
+        if generation != self.generation:
+            return  # an old connection
         if message is None:
-            self.on_close()
+            self.on_lost()
         else:
             # logger.debug("client message: %s", message)
             bin = isinstance(message, bytes)
             if bin:
                 self.last = message
+                self.lastTime = time.time()
 
             for handler in self.handlers:
                 try:
-                    if bin:
-                        handler.send_message(message, True)
-                    else:
+                    if not bin:
                         handler.write_message(message, False)
+                    elif getattr(handler, "tier", None) is None:
+                        handler.send_message(message, True)
                 except:
                     pass
+            if bin:
+                for tier in self.tiers.values():
+                    tier.push(message)
             if self.isMinicap and isinstance(message, str) and message.__contains__(" "):
                 key, val = message.split(" ", maxsplit=1)
                 self.strs[key] = val
     
+    def on_lost(self):
+        """ the upstream closed or could not connect """
+        self.conn = None
+        if self.closing or not self.handlers or self.attempts >= reconnectAttempts:
+            self.on_close()
+            return
+        if self.gapStart is None:
+            self.gapStart = time.time()
+        delay = min(reconnectMaxDelay, reconnectDelay * (2 ** self.attempts))
+        self.attempts += 1
+        logger.info("client %s lost, reconnect in %.1fs (attempt %d)", self.id, delay, self.attempts)
+        self.reconnectTimer = get_event_loop().call_later(delay, self.connect)
+    
     def on_close(self):
-        del cached_devices[self.id]
+        if cached_devices.get(self.id) is self:
+            del cached_devices[self.id]
+        if self.reconnectTimer is not None:
+            self.reconnectTimer.cancel()
+            self.reconnectTimer = None
+        self.generation += 1  # ignore connects in flight
         
         for handler in self.handlers:
             handler.close()
@@ -114,14 +264,26 @@ class ClientHandler(object):
             self.timeoutDisconn.stop()
             self.timeoutDisconn = None
         
-        logger.info("client close")
+        logger.info("client close: %s", self.id)
         self.conn = None
 
-    def add_handler(self, handler: BaseHandler):
+    def add_handler(self, handler: BaseHandler, variant=None):
+        """ variant: screenshot.Variant of the frames for handler, None for the original frames """
         for key, val in self.strs.items():
             handler.write_message(key + " " + val)
-        if self.last is not None:
-            handler.send_message(self.last, True)
+        if variant is None or variant.original:
+            if self.last is not None:
+                handler.send_message(self.last, True)
+        else:
+            tier = self.tiers.get(variant.key)
+            if tier is None:
+                tier = self.tiers[variant.key] = FrameTier(self, variant)
+            tier.handlers.append(handler)
+            handler.tier = tier
+            if tier.last is not None:
+                handler.send_message(tier.last, True)
+            elif self.last is not None:
+                tier.push(self.last)
         if self.timeoutDisconn is not None:
             self.timeoutDisconn.stop()
             self.timeoutDisconn = None
@@ -129,9 +291,19 @@ class ClientHandler(object):
     
     def del_handler(self, handler: BaseHandler):
         self.handlers.remove(handler)
-        if self.conn is not None and len(self.handlers) == 0 and self.timeoutDisconn is None:
+        tier = getattr(handler, "tier", None)
+        if tier is not None:
+            tier.handlers.remove(handler)
+            handler.tier = None
+            if not tier.handlers:
+                del self.tiers[tier.variant.key]
+        if len(self.handlers) == 0 and self.timeoutDisconn is None:
             def do_timeout():
-                self.conn.close(0, 'OK')
+                self.closing = True
+                if self.conn is not None:
+                    self.conn.close(0, 'OK')
+                else:
+                    self.on_close()
             
             self.timeoutDisconn = PeriodicCallback(do_timeout, 5000)
             self.timeoutDisconn.start()
@@ -140,13 +312,47 @@ class ClientHandler(object):
         if self.conn is not None:
             return self.conn.write_message(message, isinstance(message, bytes))
 
-def get_client(id, name):
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "connected": self.conn is not None,
+            "viewers": len(self.handlers),
+            "reconnects": self.reconnects,
+            "attempts": self.attempts,
+            "gap": time.time() - self.gapStart if self.gapStart is not None else 0.0,
+            "lastGap": self.lastGap,
+            "totalGap": self.totalGap,
+        }
+
+def get_upstream_stats():
+    """ state of the atx-agent streams, reconnects and the seconds they were down """
+    return [c.stats() for c in list(cached_devices.values())]
+
+async def get_client(id, name):
     key = id + "/" + name
     c = cached_devices.get(key)
     if c is None:
-        c = ClientHandler(id, name)
+        d = await get_device_async(id)
+        # another handler may have opened the client while connecting
+        c = cached_devices.get(key)
+        if c is None:
+            c = ClientHandler(id, name, d)
     return c
 
+def get_last_frame(id, max_age):
+    """
+    Newest frame of a running minicap stream
+
+    Returns:
+        (jpeg, receive time) or None if there is no stream or the frame is older than max_age seconds
+    """
+    c = cached_devices.get(id + "/minicap")
+    if c is None or c.conn is None or c.last is None:
+        return None
+    if time.time() - c.lastTime > max_age:
+        return None
+    return c.last, c.lastTime
+
 sysInfoRunning = True
 
 def stop_sys_info():
@@ -195,6 +401,10 @@ def sys_info_thread():
         
         sysInfoData = sysInfo
         
+        for ch in list(deviceChannels):
+            if 'sysinfo' in ch.taps:
+                ch.loop.call_soon_threadsafe(ch.push, 'sysinfo', sysInfo, False)
+
         sysInfo = '@HostInfo ' + json.dumps(sysInfo, separators=(',',':'))
         for id in cached_devices:
             if id.endswith('/minicap'):
@@ -204,18 +414,111 @@ def sys_info_thread():
 
 sysInfoThread = threading.Thread(target=sys_info_thread, name='SysInfo')
 
+frameQueueSize = 2  # frames waiting per minicap viewer, the oldest is dropped when full
+
+def setFrameQueueSize(size):
+    global frameQueueSize
+    frameQueueSize = max(1, size)
+
 class MiniCapHandler(BaseHandler):
+    """
+    Frames of a viewer wait in a small ring buffer while its socket is busy,
+    a full ring drops the oldest frame. With ?maxFps=N frames are sent at
+    most N times per second and only the newest waiting frame is sent.
+    """
     id = ""
     d = None
     loop = None
-    
-    def open(self):
-        self.loop = get_event_loop()
+    frames = None
+    sending = False
+    timer = None
+    maxFps = 0
+    nextSend = 0.0
+    tier = None
+    variant = None
+
+    def parse_arguments(self):
         self.id = self.get_query_argument("deviceId")
-        self.d = get_client(self.id, 'minicap')
-        self.d.add_handler(self)
+        self.maxFps = float(self.get_query_argument("maxFps", "0"))
+        if not math.isfinite(self.maxFps) or self.maxFps < 0:
+            raise ValueError("maxFps must be a number not below 0")
+        # quality tier, viewers with the same values share the encoded frames
+        self.variant = parse_variant(self)
+
+    async def open(self):
+        self.loop = get_event_loop()
+        variant = self.variant
+        self.frames = collections.deque()
+        self.counters = collections.Counter()
+        self.opened = time.time()
+        d = await get_client(self.id, 'minicap')
+        if self.ws_connection is None:
+            return  # closed while connecting
+        self.d = d
+        self.d.add_handler(self, variant)
         
-        logger.info("MiniCap opened: %s", self.id)
+        logger.info("MiniCap opened: %s, maxFps: %s, tier: %s", self.id, self.maxFps, variant.key[:3])
+
+    def send_message(self, msg, bin=False):
+        if not bin:
+            return super().send_message(msg, bin)
+        self.counters["receivedFrames"] += 1
+        if len(self.frames) >= frameQueueSize:
+            self.drop_frame()
+        self.frames.append(msg)
+        self.send_frame()
+
+    def drop_frame(self):
+        frame = self.frames.popleft()
+        self.counters["droppedFrames"] += 1
+        self.counters["droppedBytes"] += len(frame)
+
+    def send_frame(self):
+        if self.sending or self.timer is not None or not self.frames or self.ws_connection is None:
+            return
+        now = time.time()
+        if self.nextSend > now:
+            self.timer = self.loop.call_later(self.nextSend - now, self.on_timer)
+            return
+        if self.maxFps > 0:
+            # paced: latest frame wins
+            while len(self.frames) > 1:
+                self.drop_frame()
+            self.nextSend = now + 1 / self.maxFps
+        frame = self.frames.popleft()
+        self.sending = True
+        try:
+            fut = self.write_message(frame, True)
+        except Exception:
+            self.sending = False
+            return
+        fut.add_done_callback(lambda f: self.on_sent(f, len(frame)))
+
+    def on_timer(self):
+        self.timer = None
+        self.send_frame()
+
+    def on_sent(self, future, size):
+        self.sending = False
+        if future.exception() is not None:
+            return
+        self.counters["sentFrames"] += 1
+        self.counters["sentBytes"] += size
+        self.send_frame()
+
+    def stats(self) -> dict:
+        ret = {
+            "deviceId": self.id,
+            "remoteIp": self.request.remote_ip,
+            "maxFps": self.maxFps,
+            "seconds": time.time() - self.opened,
+            "queuedFrames": len(self.frames),
+            "queuedBytes": sum(len(frame) for frame in self.frames),
+            "tier": self.tier.stats() if self.tier is not None else None,
+        }
+        for key in ("receivedFrames", "sentFrames", "sentBytes", "droppedFrames", "droppedBytes"):
+            ret[key] = self.counters[key]
+        return ret
 
     def on_message(self, message):
         # logger.info("MiniCap message: %s", message)
@@ -223,15 +526,27 @@ class MiniCapHandler(BaseHandler):
 
     def on_close(self):
         logger.info("MiniCap closed")
-        self.d.del_handler(self)
-        self.d = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.d is not None:
+            self.d.del_handler(self)
+            self.d = None
+
+def get_minicap_stats():
+    """ counters of every minicap viewer, a viewer falling behind has a growing droppedFrames """
+    return [h.stats() for c in list(cached_devices.values()) if c.isMinicap
+            for h in c.handlers if isinstance(h, MiniCapHandler)]
 
 class MiniTouchHandler(BaseHandler):
     id = ""
     d = None
-    def open(self):
+    async def open(self):
         self.id = self.get_query_argument("deviceId")
-        self.d = get_client(self.id, "minitouch")
+        d = await get_client(self.id, "minitouch")
+        if self.ws_connection is None:
+            return  # closed while connecting
+        self.d = d
         self.d.add_handler(self)
         
         logger.info("MiniTouch opened: %s", id)
@@ -239,11 +554,281 @@ class MiniTouchHandler(BaseHandler):
     def on_message(self, message):
         # logger.info("MiniTouch message: %s", message)
         self.d.write_message(message)
+        self.d.d.invalidate_hierarchy()
 
     def on_close(self):
         logger.info("MiniTouch closed")
-        self.d.del_handler(self)
-        self.d = None
+        if self.d is not None:
+            self.d.del_handler(self)
+            self.d = None
+
+class GestureHandler(BaseHandler):
+    """
+    Touch events over one websocket, json text messages:
+        {"action": "down"|"move"|"up"|"click", "x": 100, "y": 200}
+        {"action": "swipe", "points": [[x, y, ms], ...]}  ms since the first point
+
+    Events run in the ordered lane of the device executor. A move waiting
+    behind a running event is replaced by a newer move, down/up are never
+    merged or reordered. A swipe is replayed with its timing and answered
+    with {"action": "swipe", "success": true, "duration": seconds}.
+    """
+    id = ""
+    d = None
+    loop = None
+    pending = None
+    lock = None
+    draining = False
+
+    received = 0
+    merged = 0
+
+    async def open(self):
+        self.loop = get_event_loop()
+        self.id = self.get_query_argument("deviceId")
+        self.pending = []
+        self.lock = threading.Lock()
+        self.d = await get_device_async(self.id)
+        logger.info("Gesture opened: %s", self.id)
+
+    def on_message(self, message):
+        try:
+            event = self.parse_event(json.loads(message))
+        except (ValueError, KeyError, TypeError) as e:
+            self.write_message({"success": False, "description": "invalid event: %s" % e})
+            return
+
+        with self.lock:
+            self.received += 1
+            if event[0] == 'move' and self.pending and self.pending[-1][0] == 'move':
+                self.pending[-1] = event
+                self.merged += 1
+            else:
+                self.pending.append(event)
+            if self.draining:
+                return
+            self.draining = True
+        executor.submit(self.id, self.drain, ordered=True)
+
+    def parse_event(self, data: dict):
+        action = data["action"]
+        if action == "swipe":
+            points = [(int(x), int(y), float(t) / 1000) for x, y, t in data["points"]]
+            if not points:
+                raise ValueError("empty swipe")
+            return action, points
+        if action not in ("down", "move", "up", "click"):
+            raise ValueError("unknown action " + action)
+        return action, int(data["x"]), int(data["y"])
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.draining = False
+                    return
+                event = self.pending.pop(0)
+            try:
+                self.run_event(event)
+            except Exception as e:
+                logger.warning("gesture %s error: %s", event[0], e)
+                self.reply({"action": event[0], "success": False, "description": str(e)})
+
+    def run_event(self, event):
+        touch = self.d.device.touch
+        action = event[0]
+        if action == "swipe":
+            points = event[1]
+            start = time.time()
+            touch.down(*points[0][:2])
+            for x, y, t in points[1:]:
+                delay = start + t - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                touch.move(x, y)
+            touch.up(*points[-1][:2])
+            self.d.invalidate_hierarchy()
+            self.reply({"action": action, "success": True, "duration": time.time() - start})
+        elif action == "down":
+            touch.down(event[1], event[2])
+        elif action == "move":
+            touch.move(event[1], event[2])
+        elif action == "up":
+            touch.up(event[1], event[2])
+            self.d.invalidate_hierarchy()
+        else:
+            self.d.device.click(event[1], event[2])
+            self.d.invalidate_hierarchy()
+
+    def reply(self, message):
+        self.loop.call_soon_threadsafe(self.write_message_safe, message)
+
+    def write_message_safe(self, message):
+        try:
+            self.write_message(message)
+        except:
+            pass
+
+    def on_close(self):
+        logger.info("Gesture closed: %s, %d events, %d moves merged", self.id, self.received, self.merged)
+        with self.lock:
+            self.pending.clear()
+
+class StreamTap(object):
+    """ subscriber of a ClientHandler or of sound, feeding one sub-stream of a DeviceChannelHandler """
+    tier = None
+
+    def __init__(self, channel, stream):
+        self.channel = channel
+        self.stream = stream
+        self.loop = channel.loop
+
+    def write_message(self, message, bin=False):
+        if bin:
+            self.channel.push(self.stream, message, True)
+        elif not message.startswith("@HostInfo "):
+            # sysinfo has its own sub-stream
+            self.channel.push(self.stream, message, False)
+
+    def send_message(self, message, bin=False):
+        self.write_message(message, bin)
+
+    def close(self):
+        """ the upstream closed """
+        self.channel.push(self.stream, None, False)
+
+deviceChannels = set()
+
+class DeviceChannelHandler(BaseHandler):
+    """
+    Screen, touch, audio and sysinfo of a device over one websocket.
+
+    /ws/v1/device?deviceId=android:xxx&streams=screen,touch,audio,sysinfo
+    (default all, screen takes maxWidth, maxHeight and quality like minicap)
+
+    Server to client:
+        binary: 1 byte tag (1 screen jpeg, 3 audio pcm) + payload
+        text: {"stream": "touch"|"screen"|"sysinfo", "data": ...},
+            data null means the upstream closed
+    Client to server (text):
+        {"stream": "touch", "data": "d 0 10 10 50\nc\n"}  minitouch commands
+        {"stream": "screen", "data": "..."}  minicap commands
+        {"subscribe": ["screen", "touch"]}  change the sub-streams
+
+    Every sub-stream has its own queue and only one message is written at a
+    time, always from the first non-empty queue in priority order. Screen
+    and sysinfo keep only the newest message, audio a few chunks.
+    """
+    streams = ("touch", "screen", "audio", "sysinfo")  # priority order
+    tags = {"screen": b"\x01", "audio": b"\x03"}
+    limits = {"touch": 256, "screen": 1, "audio": 8, "sysinfo": 1}
+    upstreams = {"screen": "minicap", "touch": "minitouch"}
+
+    id = ""
+    loop = None
+    taps = None
+    sending = False
+
+    def parse_arguments(self):
+        self.id = self.get_query_argument("deviceId")
+        self.variant = parse_variant(self)
+
+    async def open(self):
+        self.loop = get_event_loop()
+        self.queues = {name: collections.deque() for name in self.streams}
+        self.counters = collections.Counter()
+        self.taps = {}
+        self.clients = {}
+        deviceChannels.add(self)
+        await self.subscribe(self.get_query_argument("streams", ",".join(self.streams)).split(","))
+        logger.info("Device channel opened: %s, streams: %s", self.id, list(self.taps))
+
+    async def subscribe(self, names):
+        for name in list(self.taps):
+            if name not in names:
+                self.unsubscribe(name)
+        for name in names:
+            if name in self.streams and name not in self.taps:
+                await self.attach(name)
+
+    async def attach(self, name):
+        tap = self.taps[name] = StreamTap(self, name)
+        if name == "audio":
+            sound.add_handler(tap)
+        elif name in self.upstreams:
+            client = await get_client(self.id, self.upstreams[name])
+            if self.taps.get(name) is not tap or self.ws_connection is None:
+                return  # unsubscribed or closed while connecting
+            self.clients[name] = client
+            client.add_handler(tap, self.variant if name == "screen" else None)
+
+    def unsubscribe(self, name):
+        tap = self.taps.pop(name)
+        client = self.clients.pop(name, None)
+        if client is not None and tap in client.handlers:
+            client.del_handler(tap)
+        if name == "audio":
+            sound.del_handler(tap)
+        self.queues[name].clear()
+
+    def push(self, stream, message, bin):
+        if stream not in self.taps:
+            return
+        pending = self.queues[stream]
+        if len(pending) >= self.limits[stream]:
+            pending.popleft()
+            self.counters[stream + "Dropped"] += 1
+        pending.append((message, bin))
+        self.send_next()
+
+    def send_next(self):
+        if self.sending or self.ws_connection is None:
+            return
+        for stream in self.streams:
+            if self.queues[stream]:
+                break
+        else:
+            return
+        message, bin = self.queues[stream].popleft()
+        if bin:
+            message = self.tags[stream] + message
+        else:
+            message = json.dumps({"stream": stream, "data": message})
+        self.sending = True
+        try:
+            fut = self.write_message(message, bin)
+        except Exception:
+            self.sending = False
+            return
+        self.counters[stream + "Sent"] += 1
+        fut.add_done_callback(self.on_sent)
+
+    def on_sent(self, future):
+        self.sending = False
+        if future.exception() is None:
+            self.send_next()
+
+    def on_message(self, message):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            return
+        if "subscribe" in data:
+            ensure_future(self.subscribe(data["subscribe"]))
+            return
+        client = self.clients.get(data.get("stream"))
+        if client is not None:
+            client.write_message(data.get("data", ""))
+            if data["stream"] == "touch":
+                client.d.invalidate_hierarchy()
+
+    def on_close(self):
+        if self.taps is None:
+            return  # open failed
+        for name in list(self.taps):
+            self.unsubscribe(name)
+        deviceChannels.discard(self)
+        logger.info("Device channel closed: %s, %s", self.id, dict(self.counters))
 
 class Sound(object):
     audio: pyaudio.PyAudio = None
@@ -2,6 +2,8 @@
 #
 
 import base64
+import datetime
+import email.utils
 import io
 import json
 import os
@@ -10,22 +12,19 @@ import traceback
 import time
 import tornado
 import re
-import threading
-import queue
 import asyncio
-import concurrent.futures
 import zipfile
 from logzero import logger
 from PIL import Image
 from tornado.escape import json_decode
-from tornado.ioloop import IOLoop
-from tornado.concurrent import Future
 
-from ..device import get_device
-from .mini import get_sys_info
+from .. import actions, executor, recorder, screenshot, uidumplib
+from ..device import get_device_async, manager
+from .mini import get_sys_info, get_last_frame, get_minicap_stats, get_upstream_stats, get_client
 from ..version import __version__
 
 pathjoin = os.path.join
+reNum = re.compile('^[0-9]+$')
 
 
 channels = 2
@@ -35,10 +34,9 @@ def setChannels(c):
     channels = c
 
 async def run_in_executor(func, *args):
-    with concurrent.futures.ThreadPoolExecutor() as pool:
-        loop = asyncio.get_event_loop()
-        ret = await loop.run_in_executor(pool, func, *args)
-        return ret
+    """ run func in the shared executor, for work not bound to a device """
+    call, future = executor.submit(executor.shared_name, func, *args)
+    return await asyncio.wrap_future(future)
 
 class BaseHandler(tornado.web.RequestHandler):
     def set_default_headers(self):
@@ -57,6 +55,23 @@ class BaseHandler(tornado.web.RequestHandler):
         """ allow cors request """
         return True
 
+    async def run_on_device(self, device_id, func, *args, ordered=False):
+        """
+        Run func in the executor of device_id, calls with ordered=True (input
+        events) run one by one in submit order. Queue wait and execution time
+        are added to the Server-Timing header.
+        """
+        call, future = executor.submit(device_id, func, *args, ordered=ordered)
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            self._queue_time = getattr(self, "_queue_time", 0.0) + call.wait
+            self._exec_time = getattr(self, "_exec_time", 0.0) + call.run
+            self.set_header("Server-Timing", "queue;dur=%.1f, exec;dur=%.1f" % (
+                self._queue_time * 1000, self._exec_time * 1000))
+            logger.debug("%s %s: queue %.1fms, exec %.1fms", device_id, getattr(func, "__name__", func),
+                         call.wait * 1000, call.run * 1000)
+
 
 class VersionHandler(BaseHandler):
     def get(self):
@@ -118,9 +133,9 @@ class DeviceConnectHandler(BaseHandler):
 
         try:
             id = platform + ":" + device_url
-            d = get_device(id)
+            d = await get_device_async(id)
             if d is not None and d.device is not None:
-                d.device._prepare_atx_agent()
+                await self.run_on_device(id, d.device._prepare_atx_agent)
                 ret = {
                     "deviceId": id,
                     'success': True,
@@ -149,18 +164,184 @@ class DeviceConnectHandler(BaseHandler):
 
 class DeviceHierarchyHandler(BaseHandler):
     async def get(self, device_id):
-        d = get_device(device_id)
-        ret = await run_in_executor(d.dump_hierarchy)
-        self.write(ret)
+        d = await get_device_async(device_id)
+        fresh = self.get_argument("fresh", "0") == "1"
+        snapshot = await self.run_on_device(device_id, d.dump_snapshot, fresh)
+        self.write(snapshot.root)
+
+
+COLUMNAR_MIME_TYPE = "application/vnd.weditor.columnar+json"
 
 
 class DeviceHierarchyHandlerV2(BaseHandler):
     async def get(self, device_id):
-        d = get_device(device_id)
-        ret = await run_in_executor(d.dump_hierarchy2)
+        """
+        Query:
+            since: revision the client already has, when it is still known
+                only the added/removed/changed nodes are returned
+            format: columnar to get columnarHierarchy (see uidumplib.hierarchy_to_columns)
+                instead of jsonHierarchy, also selected by the Accept header
+            xml: 0 to omit xmlHierarchy
+            fresh: 1 to skip the hierarchy cache
+        """
+        d = await get_device_async(device_id)
+        since = self.get_argument("since", "")
+        columnar = self.get_argument("format", "") == "columnar" or \
+            COLUMNAR_MIME_TYPE in self.request.headers.get("Accept", "")
+        skip_keys = ["xmlHierarchy"] if self.get_argument("xml", "1") == "0" else []
+
+        fresh = self.get_argument("fresh", "0") == "1"
+        snapshot = await self.run_on_device(device_id, d.dump_snapshot, fresh)
+        base = d.get_snapshot(int(since)) if reNum.match(since) else None
+        if base is None:
+            if columnar:
+                skip_keys.append("jsonHierarchy")
+            ret = {k: v for k, v in snapshot.data.items() if k not in skip_keys}
+            if ret.get("xmlHierarchy"):
+                ret['xmlHierarchy'] = await run_in_executor(lambda: snapshot.pretty_xml)
+            if columnar:
+                ret['columnarHierarchy'] = await run_in_executor(lambda: snapshot.columns)
+            ret['revision'] = snapshot.revision
+        else:
+            ret = {
+                k: v
+                for k, v in snapshot.data.items()
+                if k not in ("xmlHierarchy", "jsonHierarchy")
+            }
+            ret.update(await run_in_executor(uidumplib.diff_hierarchy, base.nodes, snapshot.nodes))
+            ret.update(revision=snapshot.revision, since=base.revision,
+                       delta=True, rootId=snapshot.root['_id'])
+            # the xml can not be patched, send it whole when the tree changed
+            if base.revision != snapshot.revision and "xmlHierarchy" not in skip_keys \
+                    and snapshot.data.get("xmlHierarchy"):
+                ret['xmlHierarchy'] = await run_in_executor(lambda: snapshot.pretty_xml)
         self.write(ret)
 
 
+class HierarchySnapshotHandler(BaseHandler):
+    async def get_snapshot(self, device_id, d):
+        """
+        Query:
+            revision: snapshot to use, default is the latest one
+            fresh: 1 to dump the hierarchy again
+        """
+        if self.get_argument("fresh", "0") == "1":
+            return await self.run_on_device(device_id, d.dump_snapshot, True)
+        revision = self.get_argument("revision", "")
+        if reNum.match(revision):
+            snapshot = d.get_snapshot(int(revision))
+            if snapshot is None:
+                raise tornado.web.HTTPError(404, "revision %s expired", revision)
+            return snapshot
+        snapshot = d.last_snapshot()
+        if snapshot is None:
+            snapshot = await self.run_on_device(device_id, d.dump_snapshot)
+        return snapshot
+
+
+class DeviceHierarchyAtHandler(HierarchySnapshotHandler):
+    async def get(self, device_id):
+        """ nodes under the point (x, y), smallest area first """
+        try:
+            x = int(self.get_argument("x"))
+            y = int(self.get_argument("y"))
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+        d = await get_device_async(device_id)
+        snapshot = await self.get_snapshot(device_id, d)
+        # the index is built on first use, off the IOLoop
+        nodes = await run_in_executor(lambda: snapshot.spatial_index.at(x, y))
+        self.write({
+            "revision": snapshot.revision,
+            "nodes": nodes,
+        })
+
+
+class DeviceHierarchyRectHandler(HierarchySnapshotHandler):
+    async def get(self, device_id):
+        """ nodes intersecting the rect, or inside it with contain=1 """
+        try:
+            x = int(self.get_argument("x"))
+            y = int(self.get_argument("y"))
+            width = int(self.get_argument("width"))
+            height = int(self.get_argument("height"))
+            if width < 0 or height < 0:
+                raise ValueError("width and height must not be negative")
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+        contain = self.get_argument("contain", "0") == "1"
+        d = await get_device_async(device_id)
+        snapshot = await self.get_snapshot(device_id, d)
+        nodes = await run_in_executor(lambda: snapshot.spatial_index.within(x, y, width, height, contain))
+        self.write({
+            "revision": snapshot.revision,
+            "nodes": nodes,
+        })
+
+
+class DeviceHierarchyXPathHandler(HierarchySnapshotHandler):
+    async def get(self, device_id):
+        """ lite and full xpath of a node """
+        node_id = self.get_argument("node")
+        d = await get_device_async(device_id)
+        snapshot = await self.get_snapshot(device_id, d)
+        if node_id not in snapshot.nodes:
+            raise tornado.web.HTTPError(404, "node %s not found", node_id)
+        index = await run_in_executor(lambda: snapshot.xpath_index)
+        self.write({
+            "revision": snapshot.revision,
+            "node": node_id,
+            "lite": index.lite(node_id),
+            "full": index.full(node_id),
+        })
+
+
+class DeviceHierarchyQueryHandler(HierarchySnapshotHandler):
+    async def get(self, device_id):
+        """
+        Query:
+            xpath: xpath subset, eg: //*[@resource-id="xx"]/android.widget.TextView[2]
+            or a uiautomator2 selector, eg: ?resourceId=xx&instance=0
+        """
+        xpath = self.get_argument("xpath", None)
+        selector = {
+            k: self.get_argument(k)
+            for k in self.request.query_arguments
+            if k not in ("xpath", "revision", "fresh")
+        }
+        await self.query(device_id, xpath, selector)
+
+    async def post(self, device_id):
+        """ body: {"xpath": "..."} or {"selector": {"text": "OK"}} """
+        data = json_decode(self.request.body)
+        await self.query(device_id, data.get("xpath"), data.get("selector", {}))
+
+    async def query(self, device_id, xpath, selector):
+        d = await get_device_async(device_id)
+        snapshot = await self.get_snapshot(device_id, d)
+        def run():
+            # builds the index on first use, *Matches regexes come from the client
+            if xpath:
+                return snapshot.query_index.xpath(xpath)
+            return snapshot.query_index.select(selector)
+
+        try:
+            nodes = await run_in_executor(run)
+        except (ValueError, re.error) as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+        self.write({
+            "revision": snapshot.revision,
+            "count": len(nodes),
+            "nodes": nodes,
+        })
+
+
 class WidgetPreviewHandler(BaseHandler):
     def get(self, id):
         self.render("widget_preview.html", id=id)
@@ -266,82 +447,233 @@ class DeviceWidgetListHandler(BaseHandler):
             "data": widget_data,
         })
 
-def screenshot():
-    while True:
-        req = shotQueue.get()
-        if req is None:
-            break
-        logger.warn("screenshot begin")
-        try:
-            d = get_device("android:")
-            buffer = io.BytesIO()
-            d.screenshot().convert("RGB").save(buffer, format='JPEG')
-            b64data = base64.b64encode(buffer.getvalue())
-            code = 200
-            msg = "OK"
-            data = {
-                "type": "jpeg",
-                "encoding": "base64",
-                "data": b64data.decode('utf-8'),
-            }
-        except EnvironmentError as e:
-            code = 500
-            msg = "Environment Error"
-            data = {"description": str(e)}
-        except RuntimeError as e:
-            code = 500
-            msg = "Gone"
-            data = {"description": traceback.format_exc()}
-        logger.warn("screenshot end")
-        
-        while True:
-            req.loop.call_soon_threadsafe(req.set_status_and_write, code, msg, data)
-            try:
-                req = shotQueue.get_nowait()
-            except:
-                break
+def set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
 
-shotThread = threading.Thread(target=screenshot, name='Screenshot')
-shotQueue = queue.Queue(maxsize=10)
 
 class DeviceScreenshotHandler(BaseHandler):
-    loop: IOLoop = None
-    future: Future = None
     async def get(self, serial):
-        self.future = Future()
-        self.loop = self.future.get_loop()
-        shotQueue.put(self)
-        await self.future
+        """
+        Query:
+            format: raw for the image itself, otherwise base64 in json
+            maxWidth, maxHeight: scale down to fit, keeping the aspect ratio
+            quality: 1-100, jpeg default 75, webp default 80
+            type: jpeg (default) or webp
+            fast: 1 to use the frame of a running minicap stream when it is
+                not older than maxAge seconds (default --screenshot-max-age)
+        """
+        try:
+            variant = screenshot.Variant(
+                int(self.get_argument("maxWidth", "0")),
+                int(self.get_argument("maxHeight", "0")),
+                int(self.get_argument("quality")) if self.get_argument("quality", "") else None,
+                self.get_argument("type", "jpeg"))
+            max_age = float(self.get_argument("maxAge", str(screenshot.stream_max_age)))
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"description": str(e)})
+            return
+
+        live = get_last_frame(serial, max_age) if self.get_argument("fast", "0") == "1" else None
+        if live is not None:
+            source = "minicap"
+            frame = screenshot.stream_frame(serial, *live)
+            timing = "age;dur=%.1f" % ((time.time() - frame.created) * 1000)
+        else:
+            source = "device"
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+
+            def callback(frame, error):
+                loop.call_soon_threadsafe(set_future_result, future, (frame, error))
+
+            request = screenshot.submit(serial, callback)
+            frame, error = await future
+            if error is not None:
+                self.set_status(error.code, error.msg)
+                self.write({"description": error.description})
+                return
+            timing = "wait;dur=%.1f, capture;dur=%.1f" % (request.wait * 1000, frame.capture * 1000)
+
+        start = time.time()
+        if variant.original:
+            data = frame.data
+        else:
+            data = await run_in_executor(screenshot.encode, frame, variant)
+        self.set_header("Server-Timing", "%s, encode;dur=%.1f" % (timing, (time.time() - start) * 1000))
+        self.set_header("X-Screenshot-Source", source)
+        if self.get_argument("format", "") == "raw" or \
+                "image/jpeg" in self.request.headers.get("Accept", ""):
+            self.write_frame(frame, data, variant)
+            return
+        self.write({
+            "type": variant.image_type,
+            "source": source,
+            "encoding": "base64",
+            "data": base64.b64encode(data).decode('utf-8'),
+        })
+
 
-    def set_status_and_write(self, code, msg, data):
-        self.set_status(code, msg)
+    def write_frame(self, frame, data, variant):
+        """ image body with ETag/Last-Modified, 304 if the client has the same frame """
+        self.set_header("Content-Type", variant.content_type)
+        self.set_header("Etag", '"%s"' % variant.etag(frame))
+        self.set_header("Last-Modified", datetime.datetime.fromtimestamp(int(frame.modified), datetime.timezone.utc))
+        self.set_header("Cache-Control", "no-cache")
+        if self.request.headers.get("If-None-Match"):
+            not_modified = self.check_etag_header()
+        else:
+            not_modified = False
+            try:
+                since = email.utils.parsedate_to_datetime(self.request.headers.get("If-Modified-Since", ""))
+            except (TypeError, ValueError):
+                since = None  # missing or malformed, ignored
+            if since is not None:
+                if since.tzinfo is None:
+                    since = since.replace(tzinfo=datetime.timezone.utc)
+                not_modified = since.timestamp() >= int(frame.modified)
+        if not_modified:
+            self.set_status(304)
+            return
         self.write(data)
-        self.future.set_result(None)
+
+
+class ScreenshotStatsHandler(BaseHandler):
+    def get(self):
+        self.write({"workers": screenshot.get_stats()})
+
+
+class ExecutorStatsHandler(BaseHandler):
+    def get(self):
+        self.write({"executors": executor.get_stats()})
+
+
+class DeviceManagerStatsHandler(BaseHandler):
+    def get(self):
+        self.write({"devices": manager.stats()})
+
+
+class MiniCapStatsHandler(BaseHandler):
+    def get(self):
+        self.write({"viewers": get_minicap_stats()})
+
+
+class UpstreamStatsHandler(BaseHandler):
+    def get(self):
+        self.write({"upstreams": get_upstream_stats()})
+
 
 class DeviceScreenrecordHandler(BaseHandler):
     root = None
     def initialize(self, path: str) -> None:
         self.root = path
-    def get(self, serial, action):
-        d = get_device(serial)
+    async def get(self, serial, action):
+        d = await get_device_async(serial)
         if action == "start":
-            self.write(d.start_screenrecord(self.root))
+            self.write(await self.run_on_device(serial, d.start_screenrecord, self.root))
         elif action == "stop":
-            self.write(d.stop_screenrecord(self.root))
+            self.write(await self.run_on_device(serial, d.stop_screenrecord, self.root))
         elif action == "status":
             self.write({"status": True, "message": "OK", "result": d.isScreenRecord})
         else:
             self.set_status(404)
             self.write("action " + action + " invalid")
 
+class DeviceRecordingHandler(BaseHandler):
+    """
+    Record the minicap stream into MJPEG segments under <uploads>/recordings/<device>/
+
+    Actions:
+        start, stop, status: recorder state and the recorded segments
+        clip: frames between ?start= and ?end= (unix time) as one MJPEG file
+    """
+    root = None
+    chunk_size = 1024 * 1024
+
+    def initialize(self, path: str) -> None:
+        self.root = path
+
+    async def get(self, serial, action):
+        if action == "start":
+            with recorder.recorders_lock:
+                rec = recorder.recorders.get(serial)
+            if rec is None:
+                client = await get_client(serial, 'minicap')
+                with recorder.recorders_lock:
+                    rec = recorder.recorders.get(serial)
+                    if rec is None:
+                        rec = recorder.recorders[serial] = recorder.Recorder(serial, self.root)
+                        rec.client = client
+                        client.add_handler(rec)
+            self.write({"success": True, "recorder": rec.stats()})
+        elif action == "stop":
+            with recorder.recorders_lock:
+                rec = recorder.recorders.pop(serial, None)
+            if rec is not None:
+                if rec in rec.client.handlers:
+                    rec.client.del_handler(rec)
+                rec.stop()
+            self.write({"success": rec is not None})
+        elif action == "status":
+            with recorder.recorders_lock:
+                rec = recorder.recorders.get(serial)
+            segments = await run_in_executor(recorder.list_segments, self.root, serial)
+            self.write({
+                "recorder": rec.stats() if rec is not None else {"deviceId": serial, "recording": False},
+                "segments": segments,
+            })
+        elif action == "clip":
+            try:
+                start = float(self.get_argument("start", "0"))
+                end = float(self.get_argument("end")) if self.get_argument("end", "") else None
+                if not math.isfinite(start) or (end is not None and not math.isfinite(end)):
+                    raise ValueError("start and end must be unix times")
+                if end is not None and end < start:
+                    raise ValueError("end is before start")
+            except ValueError as e:
+                self.set_status(400)
+                self.write({"success": False, "description": str(e)})
+                return
+            await self.write_clip(serial, start, end)
+        else:
+            self.set_status(404)
+            self.write("action " + action + " invalid")
+
+    async def write_clip(self, serial, start, end):
+        ranges = await run_in_executor(recorder.clip_ranges, self.root, serial, start, end)
+        if not ranges:
+            self.set_status(404)
+            self.write({"success": False, "description": "no frames recorded in this time range"})
+            return
+        self.set_header("Content-Type", "video/x-motion-jpeg")
+        self.set_header("Content-Disposition", 'attachment; filename="%s-%d.mjpeg"' % (
+            re.sub(r'[^\w.-]', '_', serial), start))
+        self.set_header("X-Frame-Count", str(sum(r[3] for r in ranges)))
+
+        def read(path, offset, length):
+            with open(path, "rb") as f:
+                f.seek(offset)
+                return f.read(length)
+
+        for path, offset, length, _ in ranges:
+            while length > 0:
+                data = await run_in_executor(read, path, offset, min(length, self.chunk_size))
+                if not data:
+                    break
+                self.write(data)
+                await self.flush()
+                offset += len(data)
+                length -= len(data)
+
 class FloatWindowHandler(BaseHandler):
-    def get(self, serial, action):
-        d = get_device(serial)
+    async def get(self, serial, action):
+        d = await get_device_async(serial)
         if action == "show":
-            d.device.show_float_window(True)
+            await self.run_on_device(serial, d.device.show_float_window, True)
             self.finish()
         elif action == "hide":
-            d.device.show_float_window(False)
+            await self.run_on_device(serial, d.device.show_float_window, False)
             self.finish()
         else:
             self.set_status(404)
@@ -350,8 +682,8 @@ class FloatWindowHandler(BaseHandler):
 class DeviceSizeHandler(BaseHandler):
     async def post(self):
         serial = self.get_argument("serial")
-        d = get_device(serial)
-        ret = await run_in_executor(d.device.window_size)
+        d = await get_device_async(serial)
+        ret = await self.run_on_device(serial, d.device.window_size)
         w, h = ret
         self.write({"width": w, "height": h})
 
@@ -361,7 +693,7 @@ class DeviceTouchHandler(BaseHandler):
         action = self.get_argument("action")
         x = int(self.get_argument("x"))
         y = int(self.get_argument("y"))
-        d = get_device(serial)
+        d = await get_device_async(serial)
         
         def run():
             if action == 'down':
@@ -373,20 +705,19 @@ class DeviceTouchHandler(BaseHandler):
             else:
                 d.device.click(x, y)
         
-        await run_in_executor(run)
+        await self.run_on_device(serial, run, ordered=True)
+        d.invalidate_hierarchy()
         self.write({"success": True})
 
-reNum = re.compile('^[0-9]+$')
-
 class DevicePingHandler(BaseHandler):
     async def post(self):
         serial = self.get_argument("serial")
-        d = get_device(serial)
+        d = await get_device_async(serial)
         
         if d.device.retries_reset is None:
             d.device.retries_reset = 5
 
-        ret = await run_in_executor(d.device.ping)
+        ret = await self.run_on_device(serial, d.device.ping)
         self.write({"ret": ret})
 
 class DevicePressHandler(BaseHandler):
@@ -396,9 +727,10 @@ class DevicePressHandler(BaseHandler):
         if reNum.match(key):
             key = int(key)
         logger.info("PRESS KEY = " + json.dumps(key))
-        d = get_device(serial)
+        d = await get_device_async(serial)
         
-        ret = await run_in_executor(d.device.press, key)
+        ret = await self.run_on_device(serial, d.device.press, key, ordered=True)
+        d.invalidate_hierarchy()
         self.write({"ret": ret})
 
 class DeviceTextHandler(BaseHandler):
@@ -406,14 +738,37 @@ class DeviceTextHandler(BaseHandler):
         serial = self.get_argument("serial")
         text = self.get_argument("text")
         logger.info("TEXT = " + json.dumps(text))
-        d = get_device(serial)
+        d = await get_device_async(serial)
         
         def run():
-            return d.device.shell(['input', 'text', text])[1] == 0
+            return d.shell(['input', 'text', text])[1] == 0
         
-        ret = await run_in_executor(run)
+        ret = await self.run_on_device(serial, run, ordered=True)
+        d.invalidate_hierarchy()
         self.write({"ret": ret})
 
+class DeviceActionsHandler(BaseHandler):
+    async def post(self, device_id):
+        """
+        body: {"actions": [{"action": "tap", "x": 100, "y": 200}, ...], "stopOnError": true}
+        actions: tap(x, y), swipe(x1, y1, x2, y2, duration), key(key), text(text),
+            sleep(seconds), wait(selector or xpath, timeout)
+        """
+        try:
+            data = json_decode(self.request.body)
+            if not isinstance(data, dict):
+                raise ValueError("body must be a json object")
+            steps = data.get("actions")
+            actions.validate(steps)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"success": False, "description": str(e)})
+            return
+        d = await get_device_async(device_id)
+        ret = await self.run_on_device(device_id, actions.run_actions, d, steps,
+                                       data.get("stopOnError", True), ordered=True)
+        self.write(ret)
+
 def formatsize(size: int):
     if size < 1024:
         return str(size)
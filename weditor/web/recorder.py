@@ -0,0 +1,208 @@
+# coding: utf-8
+#
+# Server side recording of the minicap stream. Frames are appended to
+# MJPEG segment files (concatenated jpegs) in the uploads directory, every
+# segment has an index file with one "time offset size" line per frame, so
+# clips can be cut by wall-clock time without decoding anything.
+#
+
+import asyncio
+import os
+import queue
+import re
+import threading
+import time
+
+from logzero import logger
+
+segment_seconds = 300  # length of one segment file
+max_queue = 300  # frames waiting for the writer, more are dropped
+flush_interval = 1.0  # seconds between flushes of the segment and index files
+
+
+def set_segment_seconds(seconds: int):
+    global segment_seconds
+    segment_seconds = max(1, seconds)
+
+
+def recording_dir(root, device_id) -> str:
+    return os.path.join(root, "recordings", re.sub(r'[^\w.-]', '_', device_id))
+
+
+class Recorder(object):
+    """
+    Subscribes to a minicap ClientHandler like a viewer (write_message,
+    send_message, close), a thread writes the frames.
+    """
+    tier = None
+    client = None  # ClientHandler the frames come from
+    stopped = False
+
+    def __init__(self, device_id, root):
+        self.loop = asyncio.get_event_loop()
+        self.device_id = device_id
+        self.dir = recording_dir(root, device_id)
+        os.makedirs(self.dir, exist_ok=True)
+        self.frames = queue.Queue(max_queue)
+        self.started = time.time()
+        self.recorded = 0
+        self.recordedBytes = 0
+        self.dropped = 0
+        self.segment = None  # path of the segment being written
+        self.thread = threading.Thread(target=self.run, name="Recorder:" + device_id, daemon=True)
+        self.thread.start()
+
+    def write_message(self, message, bin=False):
+        if bin:
+            self.send_message(message, True)
+
+    def send_message(self, message, bin=False):
+        if not bin or self.stopped:
+            return
+        try:
+            self.frames.put_nowait((time.time(), message))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """ the stream closed """
+        self.stop()
+
+    def stop(self):
+        """ unregister at once, so start and status do not find the recorder while it drains """
+        with recorders_lock:
+            if recorders.get(self.device_id) is self:
+                del recorders[self.device_id]
+        self.stopped = True
+        while True:
+            try:
+                self.frames.put_nowait(None)
+                return
+            except queue.Full:
+                pass
+            # the writer is far behind, make room for the stop mark
+            try:
+                self.frames.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+    def run(self):
+        data = index = None
+        segment_end = last_flush = 0.0
+        offset = 0
+        try:
+            while True:
+                item = self.frames.get()
+                if item is None:
+                    break
+                created, frame = item
+                if data is None or created >= segment_end:
+                    if data is not None:
+                        data.close()
+                        index.close()
+                    name = time.strftime("%Y%m%d-%H%M%S", time.localtime(created)) + "-%03d" % (created % 1 * 1000)
+                    self.segment = os.path.join(self.dir, name + ".mjpeg")
+                    data = open(self.segment, "wb")
+                    index = open(os.path.join(self.dir, name + ".idx"), "w")
+                    segment_end = created + segment_seconds
+                    offset = 0
+                    logger.info("recording segment: %s", self.segment)
+                data.write(frame)
+                index.write("%.3f %d %d\n" % (created, offset, len(frame)))
+                offset += len(frame)
+                self.recorded += 1
+                self.recordedBytes += len(frame)
+                if created - last_flush >= flush_interval:
+                    data.flush()
+                    index.flush()
+                    last_flush = created
+        except OSError as e:
+            logger.warning("recording %s stopped: %s", self.device_id, e)
+        finally:
+            if data is not None:
+                data.close()
+                index.close()
+            with recorders_lock:
+                if recorders.get(self.device_id) is self:
+                    del recorders[self.device_id]
+            logger.info("recording stopped: %s", self.device_id)
+
+    def stats(self) -> dict:
+        return {
+            "deviceId": self.device_id,
+            "recording": True,
+            "started": self.started,
+            "segment": self.segment,
+            "recordedFrames": self.recorded,
+            "recordedBytes": self.recordedBytes,
+            "droppedFrames": self.dropped,
+            "queuedFrames": self.frames.qsize(),
+        }
+
+
+recorders = {}  # device_id -> Recorder
+recorders_lock = threading.Lock()
+
+
+def read_index(path):
+    """ Returns: list of (time, offset, size), an incomplete last line is skipped """
+    entries = []
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and line.endswith("\n"):
+                entries.append((float(parts[0]), int(parts[1]), int(parts[2])))
+    return entries
+
+
+def list_segments(root, device_id) -> list:
+    """ recorded segments of the device, oldest first """
+    d = recording_dir(root, device_id)
+    if not os.path.isdir(d):
+        return []
+    segments = []
+    for name in sorted(os.listdir(d)):
+        if not name.endswith(".idx"):
+            continue
+        entries = read_index(os.path.join(d, name))
+        if not entries:
+            continue
+        segments.append({
+            "name": name[:-4] + ".mjpeg",
+            "start": entries[0][0],
+            "end": entries[-1][0],
+            "frames": len(entries),
+            "bytes": entries[-1][1] + entries[-1][2],
+        })
+    return segments
+
+
+def clip_ranges(root, device_id, start=0.0, end=None) -> list:
+    """
+    Frames recorded between start and end (unix time), frames of a segment are
+    stored one after another so every segment gives one byte range.
+
+    Returns:
+        list of (segment path, offset, length, frames)
+    """
+    d = recording_dir(root, device_id)
+    ranges = []
+    for segment in list_segments(root, device_id):
+        if segment["end"] < start or (end is not None and segment["start"] > end):
+            continue
+        entries = [e for e in read_index(os.path.join(d, segment["name"][:-6] + ".idx"))
+                   if e[0] >= start and (end is None or e[0] <= end)]
+        if entries:
+            first, last = entries[0], entries[-1]
+            ranges.append((os.path.join(d, segment["name"]), first[1], last[1] + last[2] - first[1], len(entries)))
+    return ranges
+
+
+def stop_recorders(timeout=5):
+    with recorders_lock:
+        stopping = list(recorders.values())
+    for rec in stopping:
+        rec.stop()
+    for rec in stopping:
+        rec.thread.join(timeout)
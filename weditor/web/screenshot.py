@@ -0,0 +1,280 @@
+# coding: utf-8
+#
+
+import hashlib
+import io
+import threading
+import time
+import traceback
+
+from logzero import logger
+from PIL import Image
+
+from .device import get_device
+
+max_waiting = 10  # requests per device waiting for a capture to start, more are rejected
+max_joining = 1000  # requests sharing the capture in flight, they cost no extra capture
+idle_timeout = 60  # seconds before an idle worker thread exits
+max_variants = 8  # encoded sizes/qualities/types kept per frame
+stream_max_age = 1.0  # seconds a live minicap frame can stand in for a capture
+
+
+def set_stream_max_age(seconds: float):
+    global stream_max_age
+    stream_max_age = seconds
+
+
+class ScreenshotError(Exception):
+    def __init__(self, code, msg, description):
+        super().__init__(description)
+        self.code = code
+        self.msg = msg
+        self.description = description
+
+
+class Request(object):
+    """ a waiting screenshot request, callback(result, error) is called in the worker thread """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.created = time.time()
+        self.wait = 0.0  # seconds between submit and capture start
+
+
+class Frame(object):
+    def __init__(self, data: bytes, created: float, capture: float):
+        self.data = data  # jpeg
+        self.created = created  # capture end time
+        self.capture = capture  # seconds spent capturing and encoding
+        self.etag = hashlib.sha1(data).hexdigest()
+        self.modified = created  # first capture time of identical frames
+        self.variants = {}  # (max_width, max_height, quality, image_type) -> bytes
+
+
+class Variant(object):
+    """ resize/quality/type requested for a frame, see encode """
+    types = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+    def __init__(self, max_width=0, max_height=0, quality=None, image_type="jpeg"):
+        if max_width < 0 or max_height < 0:
+            raise ValueError("maxWidth and maxHeight must not be negative")
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError("quality must be between 1 and 100")
+        if image_type not in self.types:
+            raise ValueError("type must be one of " + ", ".join(self.types))
+        self.max_width = max_width
+        self.max_height = max_height
+        self.quality = quality
+        self.image_type = image_type
+        self.key = (max_width, max_height, quality, image_type)
+
+    @property
+    def content_type(self) -> str:
+        return self.types[self.image_type][1]
+
+    @property
+    def original(self) -> bool:
+        """ the captured jpeg is sent as it is """
+        return self.key == (0, 0, None, "jpeg")
+
+    def etag(self, frame: Frame) -> str:
+        if self.original:
+            return frame.etag
+        return "%s-%dx%d-%s-%s" % ((frame.etag,) + self.key)
+
+
+def encode(frame: Frame, variant: Variant) -> bytes:
+    """
+    Scale the frame down to fit maxWidth x maxHeight and encode it with the
+    requested quality and type. Results are cached on the frame, so viewers
+    polling the same thumbnail only pay for it once.
+    """
+    if variant.original:
+        return frame.data
+    data = frame.variants.get(variant.key)
+    if data is None:
+        data = encode_image(frame.data, variant)
+        if len(frame.variants) < max_variants:
+            frame.variants[variant.key] = data
+    return data
+
+
+def encode_image(jpeg: bytes, variant: Variant) -> bytes:
+    """ encode without caching, see encode """
+    im = Image.open(io.BytesIO(jpeg))
+    if variant.max_width or variant.max_height:
+        size = (variant.max_width or im.width, variant.max_height or im.height)
+        # decode at 1/2, 1/4 or 1/8 scale right in the jpeg decoder
+        im.draft("RGB", size)
+        im = im.convert("RGB")
+        im.thumbnail(size, Image.BILINEAR)
+    else:
+        im = im.convert("RGB")
+    buffer = io.BytesIO()
+    if variant.image_type == "webp":
+        # method 0 is the fastest webp encoder setting
+        im.save(buffer, format="WEBP", quality=variant.quality or 80, method=0)
+    else:
+        im.save(buffer, format="JPEG", quality=variant.quality or 75)
+    return buffer.getvalue()
+
+
+def capture(device_id) -> Frame:
+    start = time.time()
+    try:
+        d = get_device(device_id)
+        data = d.screenshot_jpeg()
+    except EnvironmentError as e:
+        raise ScreenshotError(500, "Environment Error", str(e))
+    except RuntimeError:
+        raise ScreenshotError(500, "Gone", traceback.format_exc())
+    now = time.time()
+    return Frame(data, now, now - start)
+
+
+class ScreenshotWorker(object):
+    """
+    Captures screenshots of one device in its own thread. Requests arriving
+    while a capture is running share its result.
+    """
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.waiting = []
+        self.cond = threading.Condition()
+        self.running = True
+        self.capturing = False  # requests submitted now get the capture in flight
+        self.captures = 0
+        self.served = 0
+        self.rejected = 0
+        self.last_capture = 0.0
+        self.last_frame = None
+        self.thread = threading.Thread(target=self.run, name="Screenshot:" + device_id, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: Request) -> bool:
+        """
+        Requests over max_waiting (max_joining while a capture runs, they
+        share it) are answered at once with a 503 error
+
+        Returns:
+            False if the worker already stopped
+        """
+        with self.cond:
+            if not self.running:
+                return False
+            if len(self.waiting) >= (max_joining if self.capturing else max_waiting):
+                self.rejected += 1
+                request.callback(None, ScreenshotError(503, "Busy", "%d screenshot requests waiting" % len(self.waiting)))
+                return True
+            self.waiting.append(request)
+            self.cond.notify()
+            return True
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                if self.running and not self.waiting:
+                    self.cond.wait(idle_timeout)
+                if not self.waiting:
+                    # idle or stopped
+                    self.running = False
+                    break
+                start = time.time()
+                for request in self.waiting:
+                    request.wait = start - request.created
+                self.capturing = True
+
+            logger.debug("screenshot begin: %s", self.device_id)
+            frame = error = None
+            try:
+                frame = capture(self.device_id)
+                self.last_capture = frame.capture
+                if self.last_frame is not None and self.last_frame.etag == frame.etag:
+                    frame.modified = self.last_frame.modified
+                    frame.variants = self.last_frame.variants
+                self.last_frame = frame
+            except ScreenshotError as e:
+                error = e
+            except Exception as e:
+                logger.warning("screenshot error: %s", e)
+                error = ScreenshotError(500, "Internal Server Error", str(e))
+            self.captures += 1
+
+            with self.cond:
+                batch = self.waiting
+                self.waiting = []
+                self.capturing = False
+            self.served += len(batch)
+            for request in batch:
+                request.callback(frame, error)
+
+        with workers_lock:
+            if workers.get(self.device_id) is self:
+                del workers[self.device_id]
+        logger.info("screenshot worker exit: %s", self.device_id)
+
+    def stats(self) -> dict:
+        return {
+            "deviceId": self.device_id,
+            "waiting": len(self.waiting),
+            "captures": self.captures,
+            "served": self.served,
+            "rejected": self.rejected,
+            "lastCapture": self.last_capture,
+        }
+
+
+stream_frames = {}  # device_id -> last Frame made from the minicap stream, used in the IOLoop only
+
+
+def stream_frame(device_id, data: bytes, created: float) -> Frame:
+    """ wrap a minicap frame, the same frame is wrapped once so its variants are reused """
+    last = stream_frames.get(device_id)
+    if last is not None and last.data is data:
+        return last
+    frame = Frame(data, created, 0.0)
+    if last is not None and last.etag == frame.etag:
+        frame.modified = last.modified
+        frame.variants = last.variants
+    stream_frames[device_id] = frame
+    return frame
+
+
+workers = {}
+workers_lock = threading.Lock()
+
+
+def submit(device_id, callback):
+    """ queue a screenshot of device_id, callback(frame, error) runs in the worker thread """
+    request = Request(callback)
+    while True:
+        with workers_lock:
+            worker = workers.get(device_id)
+            if worker is None:
+                worker = workers[device_id] = ScreenshotWorker(device_id)
+        if worker.submit(request):
+            return request
+        # the worker just exited on idle
+        with workers_lock:
+            if workers.get(device_id) is worker:
+                del workers[device_id]
+
+
+def get_stats() -> list:
+    with workers_lock:
+        return [worker.stats() for worker in workers.values()]
+
+
+def stop_workers(timeout=5):
+    with workers_lock:
+        stopping = list(workers.values())
+    for worker in stopping:
+        worker.stop()
+    for worker in stopping:
+        worker.thread.join(timeout)
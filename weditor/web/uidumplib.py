@@ -1,8 +1,16 @@
 # coding: utf-8
 
+import array
+import base64
+import collections
+import hashlib
+import itertools
+import json
 import re
+import sys
+import time
 import xml.dom.minidom
-import uuid
+import xml.parsers.expat
 
 sample_android_page_xml = '''<?xml version="1.0" ?>
 <hierarchy rotation="0">
@@ -27,8 +35,11 @@ sample_android_page_xml = '''<?xml version="1.0" ?>
 '''
 
 
+_bounds_re = re.compile(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]')
+
+
 def parse_bounds(text):
-    m = re.match(r'\[(\d+),(\d+)\]\[(\d+),(\d+)\]', text)
+    m = _bounds_re.match(text)
     if m is None:
         return None
     (lx, ly, rx, ry) = map(int, m.groups())
@@ -88,6 +99,23 @@ __parsers = {
 }
 
 
+def make_node_id(parent_id: str, key: str, ordinal: int) -> str:
+    """
+    Stable node id derived from the parent id, the node key (class plus
+    resource-id or name) and its ordinal among siblings sharing the same key.
+    An unchanged widget keeps its id across dumps.
+    """
+    data = "%s/%s#%d" % (parent_id, key, ordinal)
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _child_id(parent_id, seen, key):
+    """ seen: per parent counter of sibling keys """
+    ordinal = seen.get(key, 0)
+    seen[key] = ordinal + 1
+    return make_node_id(parent_id, key, ordinal)
+
+
 def _parse_uiautomator_node(node):
     ks = {}
     for key, value in node.attributes.items():
@@ -103,6 +131,31 @@ def _parse_uiautomator_node(node):
     return ks
 
 
+_rotation_re = re.compile(r'<hierarchy\b[^>]*\brotation="(\d+)"')
+
+
+def parse_rotation(page_xml: str):
+    """ rotation attribute of the uiautomator <hierarchy> element, None if missing """
+    m = _rotation_re.search(page_xml, 0, 512)
+    return int(m.group(1)) if m else None
+
+
+def pretty_xml(page_xml: str) -> str:
+    """ same formatting as uiautomator2 dump_hierarchy(pretty=True) """
+    if "\n " in page_xml:
+        return page_xml
+    dom = xml.dom.minidom.parseString(page_xml.encode('utf-8'))
+    return dom.toprettyxml(indent='  ')
+
+
+# xml attribute name -> (json key, converter), resolved once instead of per node
+_android_converters = {}
+for _key in set(__alias) | set(__parsers):
+    _alias_key = __alias.get(_key, _key)
+    if _alias_key in __parsers:
+        _android_converters[_key] = (_alias_key, __parsers[_alias_key])
+
+
 def get_android_hierarchy(d):
     page_xml = d.dump_hierarchy(compressed=False, pretty=False).encode('utf-8')
     return android_hierarchy_to_json(page_xml)
@@ -110,49 +163,784 @@ def get_android_hierarchy(d):
 
 def android_hierarchy_to_json(page_xml: bytes):
     """
+    Parse uiautomator xml in a single streaming pass (expat), without
+    building a DOM and without recursion.
+
+    Returns:
+        JSON object
+    """
+    converters = _android_converters
+    stack = []
+    seens = [{}]  # sibling key counters, seens[-1] belongs to stack[-1]
+    roots = []
+
+    def start_element(name, attrs):
+        json_node = {}
+        # attrs is a flat [key, value, key, value, ...] list
+        for i in range(0, len(attrs), 2):
+            conv = converters.get(attrs[i])
+            if conv is not None:
+                json_node[conv[0]] = conv[1](attrs[i + 1])
+        key = json_node.get('_type', name) + "|" + json_node.get('resourceId', "")
+        json_node['_id'] = _child_id(stack[-1]['_id'] if stack else "", seens[-1], key)
+        if stack:
+            parent = stack[-1]
+            children = parent.get('children')
+            if children is None:
+                children = parent['children'] = []
+            children.append(json_node)
+        else:
+            roots.append(json_node)
+        stack.append(json_node)
+        seens.append({})
+
+    def end_element(name):
+        stack.pop()
+        seens.pop()
+
+    def character_data(data):
+        # keep the minidom behavior: any content (even blank text) creates
+        # the children list
+        if stack and 'children' not in stack[-1]:
+            stack[-1]['children'] = []
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    parser.Parse(page_xml, True)
+    return roots[0] if roots else None
+
+
+def android_hierarchy_to_json_minidom(page_xml: bytes):
+    """
+    Reference implementation based on xml.dom.minidom, kept for comparison
+    (see benchmarks/hierarchy_parse.py)
+
     Returns:
         JSON object
     """
     dom = xml.dom.minidom.parseString(page_xml)
     root = dom.documentElement
 
-    def travel(node):
+    def travel(node, parent_id, seen):
         """ return current node info """
         if node.attributes is None:
             return
         json_node = _parse_uiautomator_node(node)
-        json_node['_id'] = str(uuid.uuid4())
+        key = json_node.get('_type', node.tagName) + "|" + json_node.get('resourceId', "")
+        json_node['_id'] = _child_id(parent_id, seen, key)
         if node.childNodes:
             children = []
+            child_seen = {}
             for n in node.childNodes:
-                child = travel(n)
+                child = travel(n, json_node['_id'], child_seen)
                 if child:
                     # child["_parent"] = json_node["_id"]
                     children.append(child)
             json_node['children'] = children
         return json_node
 
-    return travel(root)
+    return travel(root, "", {})
 
 
-def get_ios_hierarchy(d, scale):
+def get_ios_hierarchy(d, scale, exclude=()):
     sourcejson = d.source(format='json')
+    return ios_hierarchy_to_json(sourcejson, scale, exclude)
+
+
+def _convert_ios_node(node, scale, exclude):
+    node['_type'] = node.pop('type', "null")
+    rect = node.get('rect')
+    if rect and scale != 1:
+        node['rect'] = {k: v * scale for k, v in rect.items()}
+    for key in exclude:
+        node.pop(key, None)
+
+
+def ios_hierarchy_to_json(source, scale, exclude=()):
+    """
+    Rewrite a WDA source(format='json') tree in place, without recursion
+
+    Args:
+        source: decoded json, or the raw json text, which is then converted
+            node by node while decoding
+        scale: multiplier applied to every rect
+        exclude: attribute names dropped from every node, eg: ("frame", "rawIdentifier")
+
+    Returns:
+        JSON object
+    """
+    if isinstance(source, (str, bytes)):
+        def object_hook(obj):
+            if 'type' in obj:
+                _convert_ios_node(obj, scale, exclude)
+            return obj
+
+        source = json.loads(source, object_hook=object_hook)
+
+    # node ids need the parent id, so they are assigned top-down
+    stack = [(source, "", {})]
+    while stack:
+        node, parent_id, seen = stack.pop()
+        if '_type' not in node:
+            _convert_ios_node(node, scale, exclude)
+        key = node['_type'] + "|" + (node.get('name') or "")
+        node['_id'] = _child_id(parent_id, seen, key)
+        child_seen = {}
+        for child in reversed(node.get('children') or ()):
+            stack.append((child, node['_id'], child_seen))
+    return source
+
+
+def flatten_hierarchy(root) -> dict:
+    """
+    Flatten a json hierarchy without recursion
+
+    Returns:
+        dict of node id -> node copy, in document order. Each copy has its
+        children replaced by a list of child ids and a _parentId field
+        (except the root)
+    """
+    nodes = {}
+    stack = [(root, None)]
+    while stack:
+        node, parent_id = stack.pop()
+        flat = dict(node)
+        if parent_id is not None:
+            flat['_parentId'] = parent_id
+        children = node.get('children')
+        if children is not None:
+            flat['children'] = [child['_id'] for child in children]
+            for child in reversed(children):
+                stack.append((child, node['_id']))
+        nodes[node['_id']] = flat
+    return nodes
+
+
+def diff_hierarchy(old_nodes: dict, new_nodes: dict) -> dict:
+    """
+    Compare two flattened hierarchies (see flatten_hierarchy)
+
+    Returns:
+        dict with added and changed flat nodes, and removed node ids
+    """
+    added = []
+    changed = []
+    for node_id, node in new_nodes.items():
+        old = old_nodes.get(node_id)
+        if old is None:
+            added.append(node)
+        elif old != node:
+            changed.append(node)
+    removed = [node_id for node_id in old_nodes if node_id not in new_nodes]
+    return {"added": added, "removed": removed, "changed": changed}
+
+
+_int32_null = -2147483648
+
+
+def _pack(typecode, values) -> str:
+    """ little endian packed numbers, base64 encoded """
+    a = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return base64.b64encode(a.tobytes()).decode('ascii')
+
+
+def _is_int32(v):
+    return isinstance(v, int) and not isinstance(v, bool) and _int32_null < v < 2**31
+
+
+def _column_type(values):
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, str) for v in present):
+        return 'string'
+    if all(isinstance(v, bool) for v in present):
+        return 'bool'
+    if all(_is_int32(v) for v in present):
+        return 'int32'
+    return 'json'
+
+
+def hierarchy_to_columns(nodes: dict) -> dict:
+    """
+    Struct-of-arrays encoding of flattened nodes (see flatten_hierarchy) in
+    document order. Strings are interned into one table, numbers are packed
+    as little endian typed arrays and base64 encoded. Column types:
+        string: int32 index into strings, -1 if missing
+        bool: int8 0/1, -1 if missing
+        int32: int32, -2147483648 if missing
+        rect: int32 x, y, width, height per node, width -1 if missing
+        json: plain list, for values of any other type
+    The _parent column is the int32 index of the parent node, -1 for the root.
+    """
+    rows = list(nodes.values())
+    positions = {node['_id']: i for i, node in enumerate(rows)}
+    strings = {}
+    keys = {}
+    for node in rows:
+        for key in node:
+            keys[key] = True
+    for key in ('children', '_parentId'):
+        keys.pop(key, None)
+
+    columns = {
+        '_parent': {
+            'type': 'int32',
+            'data': _pack('i', [positions.get(node.get('_parentId'), -1) for node in rows]),
+        }
+    }
+    for key in keys:
+        values = [node.get(key) for node in rows]
+        if key == 'rect' and all(v is None or all(_is_int32(x) for x in v.values()) for v in values):
+            data = []
+            for v in values:
+                if v is None:
+                    data.extend((0, 0, -1, -1))
+                else:
+                    data.extend((v['x'], v['y'], v['width'], v['height']))
+            columns[key] = {'type': 'rect', 'data': _pack('i', data)}
+            continue
+
+        kind = _column_type(values)
+        if kind == 'string':
+            data = [-1 if v is None else strings.setdefault(v, len(strings)) for v in values]
+            data = _pack('i', data)
+        elif kind == 'bool':
+            data = _pack('b', [-1 if v is None else int(v) for v in values])
+        elif kind == 'int32':
+            data = _pack('i', [_int32_null if v is None else v for v in values])
+        else:
+            data = values
+        columns[key] = {'type': kind, 'data': data}
+
+    return {
+        'count': len(rows),
+        'strings': list(strings),
+        'columns': columns,
+    }
+
+
+class SpatialIndex(object):
+    """
+    Uniform grid of node rects, used for hit tests.
+    Nodes spanning more than max_cells cells (full screen layouts) are kept
+    in a separate list which is always scanned.
+    """
+
+    def __init__(self, nodes: dict, cell_size: int = 128, max_cells: int = 64):
+        self.cell_size = cell_size
+        self.grid = {}
+        self.large = []
+        for order, node in enumerate(nodes.values()):
+            rect = node.get('rect')
+            if not rect or rect['width'] <= 0 or rect['height'] <= 0:
+                continue
+            lx, ly = rect['x'], rect['y']
+            rx, ry = lx + rect['width'], ly + rect['height']
+            # sorted by area, then deeper (later in document order) first
+            item = (lx, ly, rx, ry, (rect['width'] * rect['height'], -order), node)
+            cx0, cy0 = lx // cell_size, ly // cell_size
+            cx1, cy1 = (rx - 1) // cell_size, (ry - 1) // cell_size
+            if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > max_cells:
+                self.large.append(item)
+                continue
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    cell = self.grid.get((cx, cy))
+                    if cell is None:
+                        cell = self.grid[(cx, cy)] = []
+                    cell.append(item)
+
+    def at(self, x, y) -> list:
+        """
+        Returns:
+            nodes containing the point (x, y), smallest area first
+        """
+        cell = self.grid.get((x // self.cell_size, y // self.cell_size), ())
+        found = [
+            item for item in itertools.chain(cell, self.large)
+            if item[0] < x < item[2] and item[1] < y < item[3]
+        ]
+        found.sort(key=lambda item: item[4])
+        return [item[5] for item in found]
+
+    def within(self, x, y, width, height, contain=False) -> list:
+        """
+        Returns:
+            nodes intersecting the rect (or fully inside it when contain is True),
+            smallest area first
+        """
+        cs = self.cell_size
+        rx, ry = x + width, y + height
+        found = {}
+        cxs = range(x // cs, (rx - 1) // cs + 1)
+        cys = range(y // cs, (ry - 1) // cs + 1)
+        if len(cxs) * len(cys) > len(self.grid):
+            # a rect larger than the screen, scan the filled cells instead
+            cells = self.grid.values()
+        else:
+            cells = (self.grid.get((cx, cy), ()) for cx in cxs for cy in cys)
+        for item in itertools.chain(self.large, *cells):
+            if contain:
+                hit = x <= item[0] and item[2] <= rx and y <= item[1] and item[3] <= ry
+            else:
+                hit = item[0] < rx and x < item[2] and item[1] < ry and y < item[3]
+            if hit:
+                found[item[4]] = item
+        return [found[key][5] for key in sorted(found)]
+
+
+# json key -> xml attribute, in the order tried by the "lite" xpath
+_xpath_attrs = (
+    ('label', 'label'),
+    ('resourceId', 'resource-id'),
+    ('text', 'text'),
+    ('description', 'content-desc'),
+)
+
+
+class XPathIndex(object):
+    """
+    Attribute value counts and sibling ordinals of a flattened hierarchy,
+    so the xpath of a node is built in O(depth)
+    """
+
+    def __init__(self, nodes: dict):
+        self.nodes = nodes
+        self.counts = {key: {} for key, _ in _xpath_attrs}
+        self.counts['_type'] = {}
+        self.ordinals = {}  # node id -> 1-based index among siblings of the same _type
+        for node in nodes.values():
+            for key, count in self.counts.items():
+                value = node.get(key)
+                if value is not None:
+                    count[value] = count.get(value, 0) + 1
+            children = node.get('children')
+            if children:
+                seen = {}
+                for child_id in children:
+                    _type = nodes[child_id].get('_type')
+                    seen[_type] = seen.get(_type, 0) + 1
+                    self.ordinals[child_id] = seen[_type]
+
+    def is_unique(self, key, value) -> bool:
+        return value is not None and self.counts[key].get(value) == 1
+
+    def _unique_step(self, node):
+        for key, attr in _xpath_attrs:
+            if self.is_unique(key, node.get(key)):
+                return '*[@%s="%s"]' % (attr, node[key])
+        if self.is_unique('_type', node.get('_type')):
+            return node['_type']
+        return None
+
+    def lite(self, node_id) -> str:
+        """ shortest xpath, stops at the first ancestor with a unique attribute """
+        steps = []
+        node = self.nodes[node_id]
+        while node.get('_parentId'):
+            step = self._unique_step(node)
+            if step is not None:
+                steps.append(step)
+                break
+            steps.append('%s[%d]' % (node.get('_type'), self.ordinals[node['_id']]))
+            node = self.nodes[node['_parentId']]
+        return "//" + "/".join(reversed(steps))
+
+    def full(self, node_id) -> str:
+        steps = []
+        node = self.nodes[node_id]
+        while node.get('_parentId'):
+            steps.append('%s[%d]' % (node.get('_type'), self.ordinals[node['_id']]))
+            node = self.nodes[node['_parentId']]
+        return "//" + "/".join(reversed(steps))
+
+
+# uiautomator2 style selector -> (json key, match kind)
+_selector_fields = {
+    'text': ('text', 'eq'),
+    'textContains': ('text', 'contains'),
+    'textMatches': ('text', 'matches'),
+    'textStartsWith': ('text', 'startswith'),
+    'className': ('_type', 'eq'),
+    'classNameMatches': ('_type', 'matches'),
+    'description': ('description', 'eq'),
+    'descriptionContains': ('description', 'contains'),
+    'descriptionMatches': ('description', 'matches'),
+    'descriptionStartsWith': ('description', 'startswith'),
+    'packageName': ('package', 'eq'),
+    'packageNameMatches': ('package', 'matches'),
+    'resourceId': ('resourceId', 'eq'),
+    'resourceIdMatches': ('resourceId', 'matches'),
+    'checkable': ('checkable', 'eq'),
+    'clickable': ('clickable', 'eq'),
+    'longClickable': ('longClickable', 'eq'),
+    'scrollable': ('scrollable', 'eq'),
+    'enabled': ('enabled', 'eq'),
+    'focusable': ('focusable', 'eq'),
+    'focused': ('focused', 'eq'),
+    'selected': ('selected', 'eq'),
+    'index': ('index', 'eq'),
+    # iOS
+    'name': ('name', 'eq'),
+    'nameContains': ('name', 'contains'),
+    'nameMatches': ('name', 'matches'),
+    'label': ('label', 'eq'),
+    'labelContains': ('label', 'contains'),
+    'labelMatches': ('label', 'matches'),
+    'value': ('value', 'eq'),
+    'valueContains': ('value', 'contains'),
+}
+
+# inverted indexes: json key -> value -> node ids
+_indexed_keys = ('resourceId', 'text', 'description', '_type', 'package')
+
+# xml attribute (as used in xpath) -> json key
+_xpath_keys = {k: v for k, v in __alias.items() if k != 'bounds'}
+_xpath_keys['type'] = '_type'  # iOS
+
+_xpath_token_re = re.compile(
+    r'''\s*(//|/|\[|\]|\(|\)|,|!=|=|@[\w:.-]+|"[^"]*"|'[^']*'|\d+|[A-Za-z_*][\w.:*-]*(?:\(\))?)''')
+
+
+def _selector_value(key, value):
+    """ selector values from a query string are strings """
+    if isinstance(value, str):
+        f = __parsers.get(key)
+        if f in (str2bool, int):
+            return f(value)
+    return value
+
+
+def _match_func(key, kind, value):
+    if kind == 'eq':
+        return lambda node: node.get(key) == value
+    if kind == 'contains':
+        return lambda node: value in (node.get(key) or "")
+    if kind == 'startswith':
+        return lambda node: (node.get(key) or "").startswith(value)
+    pattern = re.compile(value)  # matches: the whole value, like java String.matches
+    return lambda node: pattern.fullmatch(node.get(key) or "") is not None
+
+
+def _xpath_value(node, key):
+    value = node.get(key)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+class _XPathParser(object):
+    """
+    Parse the xpath subset:
+        /step, //step, name or *, [n], [last()],
+        [@attr="v"], [@attr!="v"], [text()="v"], [contains(@attr, "v")],
+        [starts-with(@attr, "v")], and, or, not(...), (...)
+    Each step is (descendant, name, predicates); a predicate is an int
+    position, -1 for last(), or (func, hint) where hint is (json key, value)
+    for plain equality on an indexed key.
+    """
+
+    def __init__(self, xpath: str):
+        self.xpath = xpath
+        self.tokens = []
+        pos = 0
+        xpath = xpath.rstrip()
+        while pos < len(xpath):
+            m = _xpath_token_re.match(xpath, pos)
+            if m is None:
+                raise ValueError("invalid xpath: %s at %d" % (xpath, pos))
+            self.tokens.append(m.group(1))
+            pos = m.end()
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self, expect=None):
+        token = self.peek()
+        if token is None or (expect is not None and token != expect):
+            raise ValueError("invalid xpath: %s, expect %r got %r" % (self.xpath, expect or "token", token))
+        self.pos += 1
+        return token
+
+    def parse(self) -> list:
+        steps = []
+        while self.peek() in ('/', '//'):
+            descendant = self.next() == '//'
+            name = self.next()
+            if name[0] in '@["\'(' or name in ('/', '//'):
+                raise ValueError("invalid xpath step: %s" % name)
+            predicates = []
+            while self.peek() == '[':
+                self.next()
+                predicates.append(self.predicate())
+                self.next(']')
+            steps.append((descendant, name, predicates))
+        if not steps or self.peek() is not None:
+            raise ValueError("invalid xpath: %s" % self.xpath)
+        return steps
+
+    def predicate(self):
+        token = self.peek() or ""
+        if token.isdigit():
+            self.next()
+            return int(token)
+        if token == 'last()':
+            self.next()
+            return -1
+        return self.or_expr()
+
+    def or_expr(self):
+        left = self.and_expr()
+        while self.peek() == 'or':
+            self.next()
+            right = self.and_expr()
+            left = (lambda a, b: lambda node: a(node) or b(node))(left[0], right[0]), None
+        return left
+
+    def and_expr(self):
+        left = self.cond()
+        while self.peek() == 'and':
+            self.next()
+            right = self.cond()
+            hint = left[1] or right[1]
+            left = (lambda a, b: lambda node: a(node) and b(node))(left[0], right[0]), hint
+        return left
+
+    def attr(self):
+        token = self.next()
+        if token == 'text()':
+            return 'text'
+        if not token.startswith('@'):
+            raise ValueError("invalid xpath attribute: %s" % token)
+        return _xpath_keys.get(token[1:], token[1:])
+
+    def literal(self):
+        token = self.next()
+        if token[0] not in '"\'':
+            raise ValueError("invalid xpath literal: %s" % token)
+        return token[1:-1]
+
+    def cond(self):
+        token = self.peek()
+        if token == '(':
+            self.next()
+            expr = self.or_expr()
+            self.next(')')
+            return expr
+        if token == 'not':
+            self.next()
+            self.next('(')
+            func = self.or_expr()[0]
+            self.next(')')
+            return (lambda node: not func(node)), None
+        if token in ('contains', 'starts-with'):
+            self.next()
+            self.next('(')
+            key = self.attr()
+            self.next(',')
+            value = self.literal()
+            self.next(')')
+            if token == 'contains':
+                return (lambda node: value in (_xpath_value(node, key) or "")), None
+            return (lambda node: (_xpath_value(node, key) or "").startswith(value)), None
+        key = self.attr()
+        op = self.next()
+        if op not in ('=', '!='):
+            raise ValueError("invalid xpath operator: %s" % op)
+        value = self.literal()
+        if op == '!=':
+            return (lambda node: _xpath_value(node, key) not in (None, value)), None
+        hint = (key, value) if key in _indexed_keys else None
+        return (lambda node: _xpath_value(node, key) == value), hint
+
+
+class QueryIndex(object):
+    """
+    Inverted indexes of resourceId, text, description, class and package,
+    used to evaluate uiautomator2 selectors and an xpath subset without
+    dumping the device again
+    """
+
+    def __init__(self, nodes: dict):
+        self.nodes = nodes
+        self.order = {}  # node id -> document order
+        self.postings = {key: {} for key in _indexed_keys}
+        for order, (node_id, node) in enumerate(nodes.items()):
+            self.order[node_id] = order
+            for key, posting in self.postings.items():
+                value = node.get(key)
+                if value is not None:
+                    ids = posting.get(value)
+                    if ids is None:
+                        ids = posting[value] = []
+                    ids.append(node_id)
+
+    def lookup(self, key, value) -> list:
+        """ node ids with node[key] == value, in document order """
+        return self.postings[key].get(value, [])
+
+    def select(self, selector: dict) -> list:
+        """
+        Evaluate a uiautomator2 style selector, eg: {"resourceId": "xx", "instance": 1}
+
+        Returns:
+            list of flat nodes in document order
+        """
+        candidates = None
+        tests = []
+        instance = None
+        for name, value in selector.items():
+            if name == 'instance':
+                instance = int(value)
+                continue
+            field = _selector_fields.get(name)
+            if field is None:
+                raise ValueError("unsupported selector: %s" % name)
+            key, kind = field
+            value = _selector_value(key, value)
+            if kind == 'eq' and key in self.postings:
+                ids = self.lookup(key, value)
+                if candidates is None:
+                    candidates = ids
+                else:
+                    found = set(ids)
+                    candidates = [node_id for node_id in candidates if node_id in found]
+            else:
+                tests.append(_match_func(key, kind, value))
+
+        if candidates is None:
+            nodes = self.nodes.values()
+        else:
+            nodes = [self.nodes[node_id] for node_id in candidates]
+        result = [node for node in nodes if all(test(node) for test in tests)]
+        if instance is not None:
+            return result[instance:instance + 1]
+        return result
+
+    def xpath(self, xpath: str) -> list:
+        """
+        Evaluate an xpath subset (see _XPathParser).
+        The root node (without class) is named hierarchy, like uiautomator.
+
+        Returns:
+            list of flat nodes in document order
+        """
+        steps = _XPathParser(xpath).parse()
+        nodes = self.nodes
+        context = None  # None is the document, parent of the root node
+        for descendant, name, predicates in steps:
+            hint = None
+            if predicates and isinstance(predicates[0], tuple):
+                hint = predicates[0][1]
+            if context is None and descendant and hint is not None:
+                candidates = [nodes[node_id] for node_id in self.lookup(*hint)]
+            elif context is None and descendant:
+                candidates = list(nodes.values())
+            elif context is None:
+                candidates = [next(iter(nodes.values()))] if nodes else []
+            else:
+                candidates = self._expand(context, descendant)
+
+            if name != '*':
+                candidates = [node for node in candidates if node.get('_type', 'hierarchy') == name]
+            for predicate in predicates:
+                if isinstance(predicate, int):
+                    candidates = self._position(candidates, predicate)
+                else:
+                    func = predicate[0]
+                    candidates = [node for node in candidates if func(node)]
+            context = candidates
+        return context
+
+    def _expand(self, context, descendant):
+        """ children (or all descendants) of context nodes, in document order """
+        nodes = self.nodes
+        found = {}
+        stack = list(context)
+        while stack:
+            node = stack.pop()
+            for child_id in node.get('children') or ():
+                if child_id in found:
+                    continue
+                child = found[child_id] = nodes[child_id]
+                if descendant:
+                    stack.append(child)
+        return sorted(found.values(), key=lambda node: self.order[node['_id']])
+
+    def _position(self, candidates, position):
+        """ [n] and [last()] are relative to the nodes sharing the same parent """
+        groups = collections.OrderedDict()
+        for node in candidates:
+            groups.setdefault(node.get('_parentId'), []).append(node)
+        result = []
+        for group in groups.values():
+            if position == -1:
+                result.append(group[-1])
+            elif 0 < position <= len(group):
+                result.append(group[position - 1])
+        result.sort(key=lambda node: self.order[node['_id']])
+        return result
+
+
+class HierarchySnapshot(object):
+    """
+    one parsed dump (the dump_hierarchy2 result), its flattened nodes and the
+    lookup indexes built from them on first use
+    """
+
+    def __init__(self, revision: int, data: dict, nodes: dict = None):
+        self.revision = revision
+        self.created = time.time()
+        self.data = data
+        self.root = data['jsonHierarchy']
+        if nodes is None:
+            nodes = flatten_hierarchy(self.root)
+        self.nodes = nodes
+        self._spatial_index = None
+        self._xpath_index = None
+        self._query_index = None
+        self._columns = None
+        self._pretty_xml = None
+
+    @property
+    def spatial_index(self) -> SpatialIndex:
+        if self._spatial_index is None:
+            self._spatial_index = SpatialIndex(self.nodes)
+        return self._spatial_index
+
+    @property
+    def xpath_index(self) -> XPathIndex:
+        if self._xpath_index is None:
+            self._xpath_index = XPathIndex(self.nodes)
+        return self._xpath_index
+
+    @property
+    def query_index(self) -> QueryIndex:
+        if self._query_index is None:
+            self._query_index = QueryIndex(self.nodes)
+        return self._query_index
+
+    @property
+    def columns(self) -> dict:
+        """ see hierarchy_to_columns """
+        if self._columns is None:
+            self._columns = hierarchy_to_columns(self.nodes)
+        return self._columns
 
-    def travel(node):
-        node['_id'] = str(uuid.uuid4())
-        node['_type'] = node.pop('type', "null")
-        if node.get('rect'):
-            rect = node['rect']
-            nrect = {}
-            for k, v in rect.items():
-                nrect[k] = v * scale
-            node['rect'] = nrect
-
-        for child in node.get('children', []):
-            travel(child)
-        return node
-
-    return travel(sourcejson)
+    @property
+    def pretty_xml(self):
+        """ formatted xmlHierarchy, None if the dump has no xml (iOS) """
+        if self._pretty_xml is None and self.data.get('xmlHierarchy'):
+            self._pretty_xml = pretty_xml(self.data['xmlHierarchy'])
+        return self._pretty_xml
 
 
 def get_webview_hierarchy(d):